@@ -13,13 +13,20 @@ import copy
 from datetime import datetime
 import os.path
 import re
+import sys
 import time
+from Queue import Queue
+from threading import Thread
 
 import numpy as np
 import tensorflow as tf
 
 from net import aquila_model as aquila
 from net.slim import slim
+from training.checkpointer import AsyncCheckpointer
+from training.checkpointer import delete_orphaned_companions
+from training.param_service import ParamClient
+from training.param_service import ParamService
 from config import *
 
 BATCH_SIZE *= num_gpus
@@ -36,7 +43,8 @@ def _tower_loss(inputs, labels, scope):
     :param inputs: A BATCH_SIZE x 299 x 299 x 3 sized float32 tensor (images)
     :param labels: A [BATCH_SIZE x BATCH_SIZE] label matrix.
     :param scope: The tower name (i.e., tower_0)
-    :returns: The total loss op.
+    :returns: A tuple of the total loss op and the [BATCH_SIZE] per-example
+    loss op.
     """
 
     # construct an instance of Aquila
@@ -46,6 +54,9 @@ def _tower_loss(inputs, labels, scope):
     # create the loss graph
     aquila.loss(logits, labels)
 
+    # the per-example losses, which are reported back to the input manager
+    example_losses = aquila.example_losses(logits, labels)
+
     # create the accuracy graph
     accuracy = aquila.accuracy(logits, labels)
     # accuracy_averages = tf.train.ExponentialMovingAverage(0.9,
@@ -68,10 +79,10 @@ def _tower_loss(inputs, labels, scope):
     tf.scalar_summary('accuracy', loss_averages.average(accuracy))
     with tf.control_dependencies([loss_averages_op]):
         total_loss = tf.identity(total_loss)
-    return total_loss
+    return total_loss, example_losses
 
 
-def _average_gradients(tower_grads):
+def _average_gradients(tower_grads, method='concat', chunk_size=None):
     """
     Calculate the average gradient for each shared variable across all towers.
 
@@ -81,9 +92,18 @@ def _average_gradients(tower_grads):
     :param tower_grads: List of lists of (gradient, variable) tuples. The outer
     list is over individual gradients. The inner list is over the gradient
     calculation for each tower.
+    :param method: How the towers' gradients are combined: 'concat' stacks
+    them and takes the mean, 'add_n' sums them in a single op and 'tree'
+    sums them pairwise. The latter two are placed on the variable's device
+    and don't materialize a stacked copy of the gradients.
+    :param chunk_size: If not None, 'add_n' and 'tree' reduce gradients of
+    more than this many elements in chunks (along their first dimension).
     :returns: List of pairs of (gradient, variable) where the gradient has been
     averaged across all towers.
     """
+    if method != 'concat':
+        return [_reduce_gradient(grad_and_vars, method, chunk_size)
+                for grad_and_vars in zip(*tower_grads)]
     average_grads = []
     for grad_and_vars in zip(*tower_grads):
         # Note that each grad_and_vars looks like the following:
@@ -109,20 +129,100 @@ def _average_gradients(tower_grads):
     return average_grads
 
 
-def train(inp_mgr, ex_per_epoch):
+def _summary_worker(summary_writer, summary_queue):
+    """
+    The target of the summary writing thread, which takes the parsing and
+    writing of summaries off the training loop.
+
+    :param summary_writer: The SummaryWriter.
+    :param summary_queue: A queue of (serialized summary, step) tuples. None
+    stops the thread once the summaries before it have been written.
+    :returns: None
+    """
+    while True:
+        item = summary_queue.get()
+        if item is None:
+            summary_writer.flush()
+            return
+        summary_writer.add_summary(*item)
+
+
+def _tree_sum(tensors):
+    """
+    Sums a list of tensors pairwise, so that no op has more than two inputs.
+    """
+    while len(tensors) > 1:
+        pairs = [tf.add(a, b) for a, b in zip(tensors[::2], tensors[1::2])]
+        tensors = pairs + tensors[len(pairs) * 2:]
+    return tensors[0]
+
+
+def _reduce_gradient(grad_and_vars, method, chunk_size=None):
+    """
+    Averages one variable's gradients across the towers with add_n or a tree
+    of adds, on the variable's device (see _average_gradients).
+
+    :param grad_and_vars: The (gradient, variable) tuple of each tower.
+    :param method: 'add_n' or 'tree'.
+    :param chunk_size: If not None, the largest number of elements to reduce
+    at once.
+    :returns: A (gradient, variable) tuple.
+    """
+    if method not in ('add_n', 'tree'):
+        raise Exception('Unknown gradient reduction %s' % method)
+    grads = [g for g, _ in grad_and_vars]
+    v = grad_and_vars[0][1]
+    if any(g is None for g in grads):
+        return None, v
+    reduce_fn = tf.add_n if method == 'add_n' else _tree_sum
+    scale = 1. / len(grads)
+    shape = v.get_shape().as_list()
+    with tf.device(v.device):
+        num_elements = int(np.prod(shape))
+        if chunk_size is None or num_elements <= chunk_size or not shape:
+            return reduce_fn(grads) * scale, v
+        # slice along the first dimension, so that each chunk holds at most
+        # chunk_size elements (or one row, if a row is larger)
+        rows = max(chunk_size // (num_elements // shape[0]), 1)
+        chunks = []
+        for start in xrange(0, shape[0], rows):
+            size = [min(rows, shape[0] - start)] + [-1] * (len(shape) - 1)
+            begin = [start] + [0] * (len(shape) - 1)
+            chunks.append(reduce_fn([tf.slice(g, begin, size)
+                                     for g in grads]) * scale)
+        return tf.concat(0, chunks), v
+
+
+def train(inp_mgr, ex_per_epoch, task_index=0):
     """
     Trains the network for some number of epochs.
 
+    NOTES:
+        If num_workers > 1, this is one of several workers that train
+        replicas of the model together, each from its own shard of the
+        input. Every step's gradients, and the batch norm moving statistics,
+        are averaged over the workers by the parameter service (see
+        training.param_service), which the chief (task 0) runs. The chief alone writes checkpoints; the other
+        workers write their summaries to a subdirectory of train_dir.
+
     :param inp_mgr: An instance of the input manager.
     :param num_epochs: The number of epochs to run for.
-    :param ex_per_epoch: The number of examples per epoch.
+    :param ex_per_epoch: The number of examples per epoch (of this worker's
+    shard, if distributed).
+    :param task_index: Which worker this is, if distributed.
     """
+    is_chief = task_index == 0
     global_step = tf.get_variable(
                 'global_step', [],
                 initializer=tf.constant_initializer(0), trainable=False)
 
-    num_batches_per_epoch = ex_per_epoch / BATCH_SIZE
-    max_steps = int(num_batches_per_epoch * NUM_EPOCHS)
+    # each step applies the gradients of accumulation_steps micro-batches
+    num_batches_per_epoch = ex_per_epoch / (BATCH_SIZE * accumulation_steps)
+    if NUM_EPOCHS is None:
+        # training from a growing win log, until it is stopped
+        max_steps = sys.maxint
+    else:
+        max_steps = int(num_batches_per_epoch * NUM_EPOCHS)
     decay_steps = int(num_batches_per_epoch * num_epochs_per_decay)
     lr = tf.train.exponential_decay(initial_learning_rate,
                                     global_step,
@@ -143,6 +243,10 @@ def train(inp_mgr, ex_per_epoch):
 
     # Calculate the gradients for each model tower.
     tower_grads = []
+    # the pair index rows of each tower's examples and their losses, if the
+    # queues carry them (see HardPairSampler)
+    tower_ids = []
+    tower_example_losses = []
 
     for i in xrange(num_gpus):
         with tf.device('/gpu:%d' % i):
@@ -150,8 +254,15 @@ def train(inp_mgr, ex_per_epoch):
                 # Calculate the loss for one tower of the ImageNet model. This
                 # function constructs the entire ImageNet model but shares the
                 # variables across all towers.
-                inputs, labels = inp_mgr.outq.dequeue_many(split_batch_size)
-                tf.scalar_summary('input_queue_size', inp_mgr.outq.size())
+                # each tower dequeues from its own queue, if there are enough
+                outq = inp_mgr.outqs[i % len(inp_mgr.outqs)]
+                if len(outq.dtypes) == 3:
+                    inputs, labels, ids = outq.dequeue_many(split_batch_size)
+                    tower_ids.append(ids)
+                else:
+                    inputs, labels = outq.dequeue_many(split_batch_size)
+                # the images may arrive as uint8; cast them on the tower.
+                inputs = tf.to_float(inputs)
                 m_4d_ = tf.reshape(labels, [1, split_batch_size,
                                             split_batch_size, 1])
                 tf.image_summary('win_matrix', m_4d_, max_images=1,
@@ -160,7 +271,8 @@ def train(inp_mgr, ex_per_epoch):
                 tf.image_summary('images', inputs, max_images=4,
                                  collections=[tf.GraphKeys.SUMMARIES],
                                  name=None)
-                loss = _tower_loss(inputs, labels, scope)
+                loss, example_losses = _tower_loss(inputs, labels, scope)
+                tower_example_losses.append(example_losses)
 
                 # Reuse variables for the next tower.
                 tf.get_variable_scope().reuse_variables()
@@ -184,11 +296,17 @@ def train(inp_mgr, ex_per_epoch):
 
     # We must calculate the mean of each gradient. Note that this is the
     # synchronization point across all towers.
-    grads = _average_gradients(tower_grads)
+    grads = _average_gradients(tower_grads, gradient_reduction,
+                               gradient_reduction_chunk_size)
 
     # Add a summaries for the input processing and global_step.
     summaries.extend(input_summaries)
 
+    # Add a summary to track the size of each of the input queues.
+    for i, outq in enumerate(inp_mgr.outqs):
+        summaries.append(tf.scalar_summary('input_queue_size/%d' % i,
+                                           outq.size()))
+
     # Add a summary to track the learning rate.
     summaries.append(tf.scalar_summary('learning_rate', lr))
 
@@ -198,8 +316,53 @@ def train(inp_mgr, ex_per_epoch):
             summaries.append(
                     tf.histogram_summary(var.op.name + '/gradients', grad))
 
-    # Apply the gradients to adjust the shared variables.
-    apply_gradient_op = opt.apply_gradients(grads, global_step=global_step)
+    # Add a summary to track the number of examples per update.
+    summaries.append(tf.scalar_summary(
+        'effective_batch_size', tf.constant(BATCH_SIZE * accumulation_steps)))
+
+    # Apply the gradients to adjust the shared variables. When accumulating,
+    # each micro-batch's gradients are summed into accumulators, and their
+    # mean is applied once every accumulation_steps micro-batches.
+    accumulators = []
+    if accumulation_steps > 1:
+        acc_grads = []
+        accumulate_ops = []
+        for grad, var in grads:
+            if grad is None:
+                continue
+            # alongside the variable (on the cpu), rather than on the
+            # default device, so that accumulating takes no gpu memory
+            with tf.device(var.device):
+                acc = tf.Variable(tf.zeros(var.get_shape()), trainable=False,
+                                  name=var.op.name + '/grad_accumulator')
+                accumulate_ops.append(acc.assign_add(grad))
+                acc_grads.append((acc * (1. / accumulation_steps), var))
+            accumulators.append((acc, grad))
+        accumulate_op = tf.group(*accumulate_ops)
+        step_grads = acc_grads
+    else:
+        step_grads = grads
+    if num_workers > 1:
+        # the step's gradients are fetched and averaged with the other
+        # workers', and the averages are fed back in to be applied.
+        step_grads = [(grad, var) for grad, var in step_grads
+                      if grad is not None]
+        grad_phds = [tf.placeholder(grad.dtype, grad.get_shape())
+                     for grad, _ in step_grads]
+        apply_gradient_op = opt.apply_gradients(
+            zip(grad_phds, [var for _, var in step_grads]),
+            global_step=global_step)
+        # the batch norm moving statistics are averaged along with them, and
+        # assigned before the averages are applied, so that the statistics
+        # (and their moving averages) are the same on every worker too.
+        moving_vars = tf.moving_average_variables()
+        stat_phds = [tf.placeholder(v.dtype.base_dtype, v.get_shape())
+                     for v in moving_vars]
+        assign_stats_op = tf.group(*[v.assign(p) for v, p in
+                                     zip(moving_vars, stat_phds)])
+    else:
+        apply_gradient_op = opt.apply_gradients(step_grads,
+                                                global_step=global_step)
 
     # Add histograms for trainable variables.
     for var in tf.trainable_variables():
@@ -219,13 +382,46 @@ def train(inp_mgr, ex_per_epoch):
 
     # Group all updates to into a single train op.
     batchnorm_updates_op = tf.group(*batchnorm_updates)
-    train_op = tf.group(apply_gradient_op, variables_averages_op,
-                                            batchnorm_updates_op)
-
-    # Create a saver.
-    saver = tf.train.Saver(tf.all_variables(), max_to_keep=20)
-
-    # Build the summary operation from the last tower summaries.
+    if accumulators:
+        # the batch norm statistics are updated by every micro-batch, and the
+        # accumulators are zeroed once their gradients have been applied.
+        accumulate_op = tf.group(accumulate_op, batchnorm_updates_op)
+        if num_workers > 1:
+            # the accumulators are zeroed once their gradients are fetched,
+            # since the averages applied may be of an earlier step's
+            zero_op = tf.group(*[acc.assign(tf.zeros_like(acc))
+                                 for acc, _ in accumulators])
+            train_op = tf.group(apply_gradient_op, variables_averages_op)
+        else:
+            with tf.control_dependencies([apply_gradient_op,
+                                          variables_averages_op]):
+                train_op = tf.group(*[acc.assign(tf.zeros_like(acc))
+                                      for acc, _ in accumulators])
+    elif num_workers > 1:
+        # the forward and backward passes are run (and the batch norm
+        # statistics updated) when the gradients are fetched.
+        compute_op = batchnorm_updates_op
+        train_op = tf.group(apply_gradient_op, variables_averages_op)
+    else:
+        train_op = tf.group(apply_gradient_op, variables_averages_op,
+                                                batchnorm_updates_op)
+
+    # the losses to report back to the input manager, if any
+    if tower_ids:
+        report_ops = [tf.concat(0, tower_ids),
+                      tf.concat(0, tower_example_losses)]
+    else:
+        report_ops = []
+
+    # The accumulators are empty between steps, so they needn't be saved.
+    acc_vars = set(acc for acc, _ in accumulators)
+    saved_vars = [v for v in tf.all_variables() if v not in acc_vars]
+
+    # Build the summary operations from the last tower summaries: one of just
+    # the (cheap) scalars, and one of everything, including the histograms
+    # and images.
+    scalar_summary_op = tf.merge_summary(
+        [x for x in summaries if x.op.type == 'ScalarSummary'])
     summary_op = tf.merge_summary(summaries)
 
     # Build an initialization operation to run below.
@@ -239,8 +435,9 @@ def train(inp_mgr, ex_per_epoch):
             log_device_placement=log_device_placement))
     sess.run(init)
 
-    # restore from a pretrained model (if requested)
-    if pretrained_model_checkpoint_path:
+    # restore from a pretrained model (if requested). The other workers
+    # receive the chief's variables below.
+    if pretrained_model_checkpoint_path and is_chief:
         assert tf.gfile.Exists(pretrained_model_checkpoint_path)
         variables_to_restore = tf.get_collection(
                 slim.variables.VARIABLES_TO_RESTORE)
@@ -249,39 +446,179 @@ def train(inp_mgr, ex_per_epoch):
         print('%s: Pre-trained model restored from %s' %
                     (datetime.now(), pretrained_model_checkpoint_path))
 
-    # start the input manager?
-    inp_mgr.start(sess)
+    # if the input manager resumed from a saved position, resume the schedule
+    # from the same step.
+    start_step = inp_mgr.start_step
+    if start_step:
+        sess.run(global_step.assign(start_step))
+        print('%s: Resuming from step %i' % (datetime.now(), start_step))
+
+    # the replicas start from the chief's variables
+    client = None
+    if num_workers > 1:
+        if is_chief:
+            service = ParamService(param_service_address,
+                                   param_service_authkey, num_workers)
+        client = ParamClient(param_service_address, param_service_authkey,
+                             max_staleness)
+        if is_chief:
+            client.broadcast(sess.run(saved_vars))
+        else:
+            print('%s: Waiting for the chief\'s variables' % datetime.now())
+            value_phds = [tf.placeholder(v.dtype.base_dtype, v.get_shape())
+                          for v in saved_vars]
+            sess.run([v.assign(p) for v, p in zip(saved_vars, value_phds)],
+                     feed_dict=dict(zip(value_phds, client.receive())))
+        step_grad_ops = [grad for grad, _ in step_grads]
 
     # summary_writer = tf.train.SummaryWriter(
     #             train_dir, graph_def=sess.graph.as_graph_def(add_shapes=True))
-    summary_writer = tf.train.SummaryWriter(train_dir, sess.graph_def)
+    summary_dir = train_dir
+    if not is_chief:
+        summary_dir = os.path.join(train_dir, 'worker_%d' % task_index)
+    summary_writer = tf.train.SummaryWriter(summary_dir, sess.graph_def)
+    summary_queue = Queue(maxsize=16)
+    summary_thread = Thread(target=_summary_worker,
+                            args=(summary_writer, summary_queue))
+    summary_thread.daemon = True
+    summary_thread.start()
+
+    # start the input manager, which reports on its workers to the summary
+    # writer
+    inp_mgr.start(sess, summary_queue, global_step)
+
+    # Create a saver. An AsyncCheckpointer only stalls training while the
+    # variables are copied out, and writes them from a thread of its own.
+    if not is_chief:
+        saver = None
+    elif async_checkpoints:
+        saver = AsyncCheckpointer(
+            saved_vars, train_dir, keep_recent=keep_recent_checkpoints,
+            keep_every_n_hours=keep_checkpoint_every_n_hours,
+            summary_queue=summary_queue)
+    else:
+        saver = tf.train.Saver(
+            saved_vars, max_to_keep=keep_recent_checkpoints,
+            keep_checkpoint_every_n_hours=keep_checkpoint_every_n_hours)
+
     print('%s: Model running for %i iterations' %
           (datetime.now(), max_steps))
-    for step in xrange(max_steps):
+    print('%s: Effective batch size %i (%i micro-batches of %i)' %
+          (datetime.now(), BATCH_SIZE * accumulation_steps,
+           accumulation_steps, BATCH_SIZE))
+    # the number of the input manager's batches consumed so far: each tower
+    # dequeues one per run that reaches the model's inputs.
+    num_batches = inp_mgr.start_batches
+    for step in xrange(start_step, max_steps):
         start_time = time.time()
-        _, loss_value = sess.run([train_op, loss])
+        # the summaries are fetched by the (last) training run of the step,
+        # rather than by a run of their own that would dequeue another batch.
+        if step % full_summary_every == 0:
+            summary_fetches = [summary_op]
+        elif step % scalar_summary_every == 0:
+            summary_fetches = [scalar_summary_op]
+        else:
+            summary_fetches = []
+        if accumulators:
+            loss_values = []
+            for n in xrange(accumulation_steps):
+                fetches = [accumulate_op, loss] + report_ops
+                if n == accumulation_steps - 1:
+                    fetches += summary_fetches
+                results = sess.run(fetches)
+                num_batches += num_gpus
+                loss_values.append(results[1])
+                if report_ops:
+                    inp_mgr.report_losses(*results[2:4])
+            if client is None:
+                sess.run(train_op)
+            else:
+                grad_values = sess.run(step_grad_ops)
+                sess.run(zero_op)
+            loss_value = np.mean(loss_values)
+        elif client is None:
+            results = sess.run([train_op, loss] + report_ops +
+                               summary_fetches)
+            num_batches += num_gpus
+            loss_value = results[1]
+            if report_ops:
+                inp_mgr.report_losses(*results[2:4])
+        else:
+            results = sess.run([compute_op, loss] + report_ops +
+                               summary_fetches + step_grad_ops)
+            num_batches += num_gpus
+            grad_values = results[-len(step_grad_ops):]
+            results = results[:-len(step_grad_ops)]
+            loss_value = results[1]
+            if report_ops:
+                inp_mgr.report_losses(*results[2:4])
+        if client is not None:
+            # apply the averaged gradients (and statistics) of step -
+            # max_staleness and, at the last step, those of the steps still
+            # outstanding
+            averages = [client.step(step,
+                                    grad_values + sess.run(moving_vars))]
+            if (step + 1) == max_steps:
+                averages.extend(client.drain(step))
+            for avg_values in averages:
+                if avg_values is None:
+                    continue
+                num_grads = len(grad_phds)
+                sess.run(assign_stats_op, feed_dict=dict(
+                    zip(stat_phds, avg_values[num_grads:])))
+                sess.run(train_op, feed_dict=dict(
+                    zip(grad_phds, avg_values[:num_grads])))
         duration = time.time() - start_time
+        if summary_fetches:
+            summary_queue.put((results[-1], step))
 
         if np.isnan(loss_value):
             print('Model is diverging (omg!) dumping data')
-            summary_str = sess.run(summary_op)
-            summary_writer.add_summary(summary_str, step)
-            checkpoint_path = os.path.join(train_dir, 'model.ckpt')
-            saver.save(sess, checkpoint_path, global_step=step)
+            summary_queue.put((sess.run(summary_op), step))
+            if is_chief:
+                checkpoint_path = os.path.join(train_dir, 'model.ckpt')
+                saver.save(sess, checkpoint_path, global_step=step)
+                if async_checkpoints:
+                    saver.close()
+            summary_queue.put(None)
+            summary_thread.join()
+            if client is not None:
+                # rather than leave the other workers waiting on this one
+                client.abort('worker %d diverged at step %d' % (task_index,
+                                                               step))
             raise Exception('Model diverged with loss = NaN on epoch %i' % step)
 
         if step % 10 == 0:
-            examples_per_sec = BATCH_SIZE / float(duration)
+            examples_per_sec = (BATCH_SIZE * accumulation_steps /
+                                float(duration))
             format_str = ('%s: step %d, loss = %.2f (%.1f examples/sec; '
                           '%.3f sec/batch)')
             print(format_str % (datetime.now(), step, loss_value,
                                                     examples_per_sec, duration))
 
-        if step % 200 == 0:
-            summary_str = sess.run(summary_op)
-            summary_writer.add_summary(summary_str, step)
-
         # Save the model checkpoint periodically.
-        if step % 10000 == 0 or (step + 1) == max_steps:
+        if is_chief and (step % 10000 == 0 or (step + 1) == max_steps):
             checkpoint_path = os.path.join(train_dir, 'model.ckpt')
-            saver.save(sess, checkpoint_path, global_step=step)
+            save_start = time.time()
+            saved_path = saver.save(sess, checkpoint_path, global_step=step)
+            # the time training was stalled by the save
+            summary_queue.put((tf.Summary(value=[tf.Summary.Value(
+                tag='checkpoint/save_seconds',
+                simple_value=time.time() - save_start)]), step))
+            # the workers' input managers share a position, so the chief's
+            # is theirs too.
+            inp_mgr.save_state(saved_path + '.input', step, num_batches)
+            if not async_checkpoints:
+                # the saver deletes old checkpoints, but not their companions
+                delete_orphaned_companions(train_dir)
+
+    # write out any checkpoints and summaries still queued
+    if is_chief and async_checkpoints:
+        saver.close()
+    summary_queue.put(None)
+    summary_thread.join()
+    if client is not None:
+        client.close()
+        if is_chief:
+            # the other workers may still be pulling their last averages
+            service.join()
@@ -4,6 +4,11 @@ the current one was incorrectly generated!
 
 We will generate the win matrix from the JSON data as well as
 the legacy win lists.
+
+The trials of the JSON data are also written out as a trial list, one
+trial per line as win1,lose1,win2,lose2 (indices), for trial-structured
+batches. The legacy win lists only have aggregated counts, so their
+trials can't be recovered.
 """
 
 from glob import glob
@@ -22,6 +27,7 @@ WIN_MATRIX_LOC = '/Users/davidlea/Desktop/testing/task_data/datasets/train/win_m
 ALT_WIN_MATRIX_LOC = '/Users/davidlea/Desktop/testing/task_data/datasets/test/win_matrix.mtx'
 WIN_LIST_LOC = '/Users/davidlea/Desktop/testing/task_data/win_lists/newtask.csv'
 LEG_WIN_LIST_LOC = '/Users/davidlea/Desktop/testing/task_data/win_lists/legacy.csv'
+TRIAL_LIST_LOC = '/Users/davidlea/Desktop/testing/task_data/combined_trial_data'
 
 fnmap = dict()
 ifnmap = dict()
@@ -105,12 +111,14 @@ def update_win_table_from_parse(parse):
 
 print 'Wins in win table:', sum([sum(x.values()) for k, x in win_tab.iteritems()])
 print 'updating win table with new information'
+trials = []
 for n, cfile in enumerate(files):
 	if not n % 100:
 		print '%i / %i' % (n, len(files))
 	blocks = read_file(cfile)
 	dat = parse_blocks(blocks)
 	update_win_table_from_parse(dat)
+	trials.extend(parse_to_idx(dat))
 # win_matrix = sparse.lil_matrix((len(ifnmap, ifnmap)))
 print 'Final wins in win table:', sum([sum(x.values()) for k, x in win_tab.iteritems()])
 
@@ -146,5 +154,10 @@ with open(targ, 'w') as f:
 			f.write('%s,%s,%i\n' % (wnr, lsr, n))
 			tot += 1
 
+print 'Writing %i trials' % len(trials)
+with open(TRIAL_LIST_LOC, 'w') as f:
+	for win1, lose1, win2, lose2, choice_type, choice in trials:
+		f.write('%i,%i,%i,%i\n' % (win1, lose1, win2, lose2))
+
 # targ = '/Users/davidlea/Desktop/testing/task_data/correct_win_matrix.mtx'
 # io.mmwrite(targ, win_matrix.astype(int))
\ No newline at end of file
@@ -14,13 +14,137 @@ num_gpus = 4
 # Whether to log device placement.
 log_device_placement = False  # this produces *so much* output!
 
-# the number of preprocessing threads to create -- just 2 is more than
-# sufficient, even for 4 gpus (apparently?)
+# the number of preprocessing threads to start with. The input manager adds
+# or retires threads, within [min_preprocess_threads, max_preprocess_threads],
+# to keep the input queues from running dry without overfilling them.
 num_preprocess_threads = 1
+min_preprocess_threads = 1
+max_preprocess_threads = 8
+
+# how images are decoded and augmented: 'tf' does it in the TensorFlow graph,
+# 'process' does it in a pool of num_decode_procs worker processes (see
+# training.decode_pool), 'mmap' crops pre-decoded images out of the store in
+# image_store_dir (see utility/build_image_store.py), 'cached' decodes in the
+# feeder threads through an LRU cache of image_cache_bytes (see
+# training.image_cache), 'packed' decodes in the TensorFlow graph but slices
+# the encoded images out of the store in jpeg_store_dir rather than reading
+# a file per image (see utility/build_jpeg_store.py), 'prefetch' decodes in
+# the TensorFlow graph but reads the files of upcoming batches ahead of time
+# with many concurrent reads, for high-latency storage (see
+# training.prefetch)
+input_backend = 'tf'
+
+# the number of decoding processes when input_backend == 'process'
+num_decode_procs = 8
+
+# the location of the pre-decoded image store when input_backend == 'mmap'
+image_store_dir = '/data/image_store'
+
+# the byte budget of the decoded image cache when input_backend == 'cached'
+image_cache_bytes = 8 * 2**30
+
+# the location of the packed JPEG store when input_backend == 'packed', and
+# whether to read it into memory up front rather than memory-map it
+jpeg_store_dir = '/data/jpeg_store'
+jpeg_store_in_memory = False
+
+# when input_backend == 'prefetch', the number of file reads in flight at once
+# and the number of batches that may be read ahead of the feeder threads
+num_prefetch_reads = 256
+num_prefetch_batches = 16
+
+# whether to pass images through the input queue as uint8 (and cast them to
+# float on each tower) rather than float32, which quarters the queue's memory
+uint8_transport = True
+
+# whether to give each tower its own input queue, which the feeder threads
+# fill round-robin, rather than have all the towers share one
+per_tower_queues = True
 
 # the number of abstract features to learn
 abs_feats = 1024
 
+# how pairs are drawn from the win list: 'repeat' enqueues a pair once per
+# win, 'weighted' enqueues each distinct pair once per epoch with its win
+# counts as the labels, 'proportional' draws pairs in proportion to their
+# win counts (see training.input.PAIR_SAMPLING_MODES)
+pair_sampling = 'repeat'
+
+# whether to compose batches of images with many comparisons among themselves
+# rather than of independent pairs (see training.composer)
+dense_batches = False
+
+# if not empty, a list of MTurk trials (see assembly/assemble_new_data.py),
+# whose three images and two comparisons are kept together in a batch (see
+# training.composer.TrialBatchComposer), rather than drawing independent
+# pairs from the win list
+trial_list_loc = ''  # '/data/datasets/combined_trial_data'
+
+# if not empty, the on-disk positions of the images (see
+# utility/build_file_positions.py). Each epoch is then shuffled in chunks of
+# locality_chunk_size pairs, sorted by disk position, and reshuffled within
+# windows of locality_buffer_size pairs, so that reads are mostly sequential.
+file_positions_loc = ''  # '/data/datasets/file_positions.npy'
+locality_chunk_size = 2**20
+locality_buffer_size = 4096
+
+# if not empty, an append-only win log (in the format of the win list) from
+# which pairs are drawn as new comparisons land, rather than epochs over the
+# fixed win list (see training.win_stream). Pairs are drawn in proportion to
+# their wins, with recently compared pairs up to 1 + stream_recency_boost
+# times as likely; the boost halves every stream_half_life new comparisons.
+# The log is checked every stream_poll_interval seconds. With a win log,
+# NUM_EPOCHS may be None to train indefinitely.
+win_log_loc = ''  # '/data/datasets/win_log'
+stream_half_life = 10**6
+stream_recency_boost = 4.
+stream_poll_interval = 60
+
+# whether to draw pairs in proportion to their most recent losses (see
+# training.hard_pairs), rather than as pair_sampling alone would. The draw
+# probabilities are recomputed every hard_pair_refresh batches.
+# hard_pair_alpha sharpens (> 1) or flattens (< 1) the preference for hard
+# pairs, hard_pair_beta is how fully the resulting bias is corrected for, and
+# hard_pair_mix is the fraction of draws made without regard to the losses.
+hard_pair_sampling = False
+hard_pair_alpha = 1.
+hard_pair_beta = 1.
+hard_pair_mix = 0.1
+hard_pair_refresh = 1000
+
+# how often (in steps) to write the scalar summaries, and all the summaries
+# (including the histograms and images, which are much costlier)
+scalar_summary_every = 50
+full_summary_every = 1000
+
+# whether to write checkpoints from a background thread (see
+# training.checkpointer), so that training only stalls while the variables
+# are copied out. The most recent keep_recent_checkpoints checkpoints are
+# kept, along with one every keep_checkpoint_every_n_hours hours.
+async_checkpoints = True
+keep_recent_checkpoints = 5
+keep_checkpoint_every_n_hours = 2.
+
+# the seed from which the input's epoch orderings are drawn. If None, one is
+# chosen at random.
+input_seed = None
+
+# the number of worker processes (on this machine or others) that train
+# replicas of the model together, each from its own shard of every epoch.
+# Each worker is started with its task index as its argument (see
+# init_train.py, and utility/launch_local_workers.py to start them all on one
+# machine); task 0, the chief, runs the parameter service (see
+# training.param_service) at param_service_address and writes the
+# checkpoints. Every step's gradients (and batch norm moving statistics) are
+# averaged over the workers, so the replicas stay identical; with a
+# max_staleness of 0 the workers step in lockstep, otherwise each may run up
+# to max_staleness steps ahead of the slowest. The workers must share
+# input_seed, and see this file and the pretrained model's input state alike.
+num_workers = 1
+param_service_address = ('localhost', 2222)
+param_service_authkey = 'aquila'
+max_staleness = 0
+
 # ---------------------------------------------------------------------------- #
 # Flags governing the type of training.
 # ---------------------------------------------------------------------------- #
@@ -42,6 +166,19 @@ learning_rate_decay_factor = 0.65
 
 BATCH_SIZE = 22
 
+# the number of micro-batches (of BATCH_SIZE per gpu) whose gradients are
+# accumulated and applied together, for larger effective batches than fit in
+# memory
+accumulation_steps = 1
+
+# how the towers' gradients are averaged: 'concat' stacks them and takes the
+# mean, 'add_n' and 'tree' sum them (in one op, or pairwise) on the
+# variables' device without the stacked copy (see
+# utility/benchmark_gradient_reduction.py). If not None, gradients of more
+# than gradient_reduction_chunk_size elements are reduced in chunks.
+gradient_reduction = 'concat'
+gradient_reduction_chunk_size = None
+
 NUM_EPOCHS = 5
 
 # Constants dictating the learning rate schedule.
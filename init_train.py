@@ -7,13 +7,21 @@ NOTES:
     with the lil matrices used to create the sparse matrices. In practice,
     it appears to be both. From now on, we won't be using sparse matrices,
     we're going to be reading an enumeration of all win events in the data.
+
+    If config.num_workers > 1, run one of these per worker, with the worker's
+    task index as the argument, e.g.:
+        python init_train.py 1
 """
 
 from training.input import InputManagerWinList
 from training.input import get_enqueue_op
+from training.input import get_array_enqueue_op
+from training.input import get_encoded_enqueue_op
 import aquila_train
 import config
 
+import os
+import sys
 import numpy as np
 import tensorflow as tf
 
@@ -32,39 +40,146 @@ else:
 
 WIN_LIST_LOC = '/data/datasets/combined_win_data'
 
+DEBUG_DIR = '/data/training_epoch_sequence'
+
+# which of the config.num_workers workers this is
+TASK_INDEX = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+if config.num_workers > 1:
+    if config.input_seed is None:
+        raise Exception('The workers must share a config.input_seed')
+    # each worker records the ordering of its own shard
+    DEBUG_DIR = os.path.join(DEBUG_DIR, 'worker_%i' % TASK_INDEX)
+    if not os.path.exists(DEBUG_DIR):
+        os.makedirs(DEBUG_DIR)
+
+# the position of the input is saved alongside each checkpoint; if there is
+# one for the pretrained model, resume from it.
+INPUT_STATE_LOC = config.pretrained_model_checkpoint_path + '.input'
+if config.pretrained_model_checkpoint_path and os.path.exists(INPUT_STATE_LOC):
+    resume_from = INPUT_STATE_LOC
+else:
+    resume_from = None
+
 fnmap = dict()
 print 'Loading index to filename map'
 with open(FILE_MAP_LOC, 'r') as f:
     for line in f:
         idx, fn = line.strip().split(',')
         fnmap[int(idx)] = fn + '.jpg'
-print 'Constructing win list'
-win_list = []
-with open(WIN_LIST_LOC, 'r') as f:
-    for line in f:
-        a, b, n = line.split(',')
-        win_list.append([int(a), int(b), int(n)])
+if config.win_log_loc:
+    from training.win_stream import WinLogSampler
+    print 'Opening win log'
+    win_list = None
+    win_stream = WinLogSampler(config.win_log_loc, BATCH_SIZE,
+                               valid_images=fnmap,
+                               half_life=config.stream_half_life,
+                               recency_boost=config.stream_recency_boost,
+                               poll_interval=config.stream_poll_interval)
+else:
+    print 'Constructing win list'
+    win_list = np.loadtxt(WIN_LIST_LOC, delimiter=',', dtype=np.int32,
+                          ndmin=2)
+    win_stream = None
+if config.trial_list_loc:
+    print 'Loading trial list'
+    trial_list = np.loadtxt(config.trial_list_loc, delimiter=',',
+                            dtype=np.int32, ndmin=2)
+else:
+    trial_list = None
+if config.file_positions_loc:
+    print 'Loading file positions'
+    file_positions = np.load(config.file_positions_loc)
+else:
+    file_positions = None
 
 # win_matrix = sparse.lil_matrix(io.mmread(WIN_MATRIX_LOC).astype(np.uint8))
 
-outQ = tf.FIFOQueue(BATCH_SIZE*16, [tf.float32, tf.float32], shapes=[[299, 299,
-                                                                    3],
-                                                           [BATCH_SIZE]])
-fn_phds = [tf.placeholder(tf.string, shape=[]) for _ in range(BATCH_SIZE)]
-lab_phds = [tf.placeholder(tf.int32, 
-                           shape=[BATCH_SIZE]) for _ in range(BATCH_SIZE)]
-enq_op = get_enqueue_op(fn_phds, lab_phds, outQ)
+if config.uint8_transport:
+    # uint8 images are a quarter of the size, so prefetch four times as deep
+    im_dtype, capacity = tf.uint8, BATCH_SIZE*64
+else:
+    im_dtype, capacity = tf.float32, BATCH_SIZE*16
+# the memory budget is split evenly between the towers' queues
+num_queues = config.num_gpus if config.per_tower_queues else 1
+if config.hard_pair_sampling:
+    # each image also carries the pair index row of its pair, so that the
+    # towers can report the pair's loss; the labels are importance-weighted.
+    dtypes = [im_dtype, tf.float32, tf.int32]
+    shapes = [[299, 299, 3], [BATCH_SIZE], []]
+    id_phd = tf.placeholder(tf.int32, shape=[BATCH_SIZE])
+    lab_dtype = tf.float32
+else:
+    dtypes = [im_dtype, tf.float32]
+    shapes = [[299, 299, 3], [BATCH_SIZE]]
+    id_phd = None
+    lab_dtype = tf.int32
+outQ = [tf.FIFOQueue(capacity // num_queues, dtypes, shapes=shapes)
+        for _ in range(num_queues)]
+lab_phd = tf.placeholder(lab_dtype, shape=[BATCH_SIZE, BATCH_SIZE])
+if config.input_backend in ['process', 'mmap', 'cached']:
+    # the decoding is done outside of TensorFlow, so we feed whole batches
+    if config.input_backend == 'process':
+        from training.decode_pool import JpegDecodePool
+        loader = JpegDecodePool(fnmap, IMG_DIR, BATCH_SIZE,
+                                num_procs=config.num_decode_procs)
+    elif config.input_backend == 'mmap':
+        from training.image_store import MmapImageStore
+        loader = MmapImageStore(config.image_store_dir, BATCH_SIZE)
+    else:
+        from training.image_cache import CachedJpegLoader
+        loader = CachedJpegLoader(fnmap, IMG_DIR, BATCH_SIZE,
+                                  config.image_cache_bytes)
+    fn_phd = tf.placeholder(tf.uint8, shape=[BATCH_SIZE, 299, 299, 3])
+    enq_op = get_array_enqueue_op(fn_phd, lab_phd, outQ, id_phd)
+elif config.input_backend in ['packed', 'prefetch']:
+    # the encoded images are fed from memory and decoded by TensorFlow
+    if config.input_backend == 'packed':
+        from training.jpeg_store import PackedJpegStore
+        loader = PackedJpegStore(config.jpeg_store_dir, BATCH_SIZE,
+                                 in_memory=config.jpeg_store_in_memory)
+    else:
+        from training.prefetch import FilePrefetcher
+        loader = FilePrefetcher(fnmap, IMG_DIR, BATCH_SIZE,
+                                num_reads=config.num_prefetch_reads,
+                                num_batches=config.num_prefetch_batches)
+    fn_phd = tf.placeholder(tf.string, shape=[BATCH_SIZE])
+    enq_op = get_encoded_enqueue_op(fn_phd, lab_phd, outQ, id_phd)
+else:
+    loader = None
+    fn_phd = tf.placeholder(tf.string, shape=[BATCH_SIZE])
+    enq_op = get_enqueue_op(fn_phd, lab_phd, outQ, id_phd)
 
-# imgr = InputManager(win_matrix, fnmap, IMG_DIR, outQ, fn_phds, lab_phds,
+# imgr = InputManager(win_matrix, fnmap, IMG_DIR, outQ, fn_phd, lab_phd,
 #                     enq_op, BATCH_SIZE, num_epochs=NUM_EPOCHS, num_threads=1,
 #                     debug_dir='/data/training_epoch_sequence',
 #                     single_win_mapping=True)
 
-imgr = InputManagerWinList(win_list, fnmap, IMG_DIR, outQ, fn_phds, lab_phds,
-                    enq_op, BATCH_SIZE, num_epochs=NUM_EPOCHS, num_threads=1,
-                    debug_dir='/data/training_epoch_sequence',
-                    single_win_mapping=True)
+imgr = InputManagerWinList(win_list, fnmap, IMG_DIR, outQ, fn_phd, lab_phd,
+                    enq_op, BATCH_SIZE, num_epochs=NUM_EPOCHS,
+                    num_threads=config.num_preprocess_threads,
+                    min_threads=config.min_preprocess_threads,
+                    max_threads=config.max_preprocess_threads,
+                    debug_dir=DEBUG_DIR,
+                    single_win_mapping=True,
+                    pair_sampling=config.pair_sampling,
+                    loader=loader,
+                    dense_batches=config.dense_batches,
+                    seed=config.input_seed,
+                    resume_from=resume_from,
+                    file_positions=file_positions,
+                    locality_chunk_size=config.locality_chunk_size,
+                    locality_buffer_size=config.locality_buffer_size,
+                    win_stream=win_stream,
+                    hard_pairs=config.hard_pair_sampling,
+                    id_phd=id_phd,
+                    hard_pair_alpha=config.hard_pair_alpha,
+                    hard_pair_beta=config.hard_pair_beta,
+                    hard_pair_mix=config.hard_pair_mix,
+                    trial_list=trial_list,
+                    num_shards=config.num_workers,
+                    shard_index=TASK_INDEX,
+                    hard_pair_refresh=config.hard_pair_refresh)
 
-aquila_train.train(imgr, imgr.num_ex_per_epoch)
+aquila_train.train(imgr, imgr.num_ex_per_epoch, task_index=TASK_INDEX)
 
 
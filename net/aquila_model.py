@@ -96,6 +96,21 @@ def loss(logits, labels):
     slim.losses.ranknet_loss(logits[1], labels, weight=0.4, scope='aux_loss')
 
 
+def example_losses(logits, labels):
+    """
+    Computes the RankNet loss of each image in the batch (see
+    slim.losses.ranknet_example_losses), e.g. to find the hard pairs. The
+    auxiliary logit head is disregarded.
+
+    :param logits: The predicted image scores as a list of [BATCH_SIZE]
+    float32 tensors. Note that only the first element of this list is used.
+    :param labels: The labels, a [BATCH_SIZE, BATCH_SIZE] float32 tensor.
+    :return: A [BATCH_SIZE] float32 tensor.
+    """
+    return slim.losses.ranknet_example_losses(logits[0], labels,
+                                              scope='example_losses')
+
+
 def accuracy(logits, labels):
     """
     Computes the accuracy of the output of the final logit layer. We
@@ -118,6 +118,38 @@ def ranknet_loss(y, m_, conf=0.999, weight=1.0, scope=None):
         return weight * loss_
 
 
+def ranknet_example_losses(y, m_, conf=0.999, scope=None):
+    """
+    Computes the RankNet loss of each example separately, i.e., the loss over
+    the comparisons it takes part in (in either direction), normalized by
+    their number. The losses are not added to the loss collection.
+
+    NOTES:
+        y and m_ must be the same shape!
+
+        When the batch is made of pairs, both images of a pair get that
+        pair's loss.
+
+    :param y: A tensor of predictions from the network. (float32)
+    :param m_: The win matrix, m_[i,j] = number of times i has beaten j. (
+    float32)
+    :param conf: "Confidence" (see ranknet_loss).
+    :param scope: The scope for this operation.
+    :return: A [batch_size] float32 tensor of losses, which are 0 for
+    examples that take part in no comparisons.
+    """
+    with tf.op_scope([y, m_], scope, 'RankNetExampleLosses'):
+        ones_ = tf.ones_like(m_, dtype=tf.float32)
+        y_m_ = tf.mul(y, ones_)
+        y_diff_ = tf.sub(y_m_, tf.transpose(y_m_))
+        t_1_ = -tf.mul(conf*ones_, y_diff_)
+        t_2_ = tf.log(ones_ + tf.exp(y_diff_))
+        mult_sum_ = tf.mul(m_, tf.add(t_1_, t_2_))
+        losses_ = tf.reduce_sum(mult_sum_ + tf.transpose(mult_sum_), 1)
+        counts_ = tf.reduce_sum(m_ + tf.transpose(m_), 1)
+        return losses_ / tf.maximum(counts_, 1e-8)
+
+
 def accuracy(y, m_, scope=None):
     """
     Computes accuracy (fraction of correct predictions).
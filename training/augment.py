@@ -0,0 +1,31 @@
+"""
+Image augmentation performed outside of the TensorFlow graph, for the input
+backends that hand ready-made arrays to the queue. It mirrors the
+augmentation done by get_enqueue_op.
+"""
+
+import numpy as np
+
+CROP_SIZE = 299  # the size of the (square) random crop
+NUM_CHANNELS = 3
+
+
+def random_crop_flip(image, out=None):
+    """
+    Randomly crops an image to 299 x 299 and randomly flips it left/right.
+
+    :param image: A uint8 array of shape [h, w, 3] with h, w >= 299
+    :param out: If not None, a uint8 array of shape [299, 299, 3] into which
+    the result is written.
+    :return: The augmented image.
+    """
+    h, w = image.shape[:2]
+    y = np.random.randint(h - CROP_SIZE + 1)
+    x = np.random.randint(w - CROP_SIZE + 1)
+    crop = image[y:y + CROP_SIZE, x:x + CROP_SIZE]
+    if np.random.randint(2):
+        crop = crop[:, ::-1]
+    if out is None:
+        return np.ascontiguousarray(crop)
+    out[...] = crop
+    return out
@@ -0,0 +1,189 @@
+"""
+Writes checkpoints from a background thread, so that training only stalls
+for as long as it takes to copy the variables out of the session. The
+checkpoints are ordinary Saver checkpoints (under the variables' own names),
+so they are restored as usual.
+
+Each checkpoint is written under a temporary name and renamed into place, so
+a checkpoint that exists is complete. The most recent keep_recent
+checkpoints are kept, along with one every keep_every_n_hours, including
+those written by earlier runs into the same directory.
+"""
+
+import os
+from glob import glob
+import time
+from Queue import Queue
+from threading import Thread
+
+import tensorflow as tf
+
+# the files that are kept alongside a checkpoint (e.g., the input manager's
+# state), and deleted with it
+COMPANION_SUFFIXES = ['.input', '.meta']
+
+
+def delete_orphaned_companions(save_dir):
+    """
+    Deletes the companion files whose checkpoints have been deleted, e.g.,
+    by a tf.train.Saver's own retention.
+
+    :param save_dir: The directory the checkpoints are written to.
+    :return: None
+    """
+    for suffix in COMPANION_SUFFIXES:
+        for fn in glob(os.path.join(save_dir, '*' + suffix)):
+            if not os.path.exists(fn[:-len(suffix)]):
+                os.remove(fn)
+
+
+class AsyncCheckpointer(object):
+    def __init__(self, variables, save_dir, keep_recent=5,
+                 keep_every_n_hours=2., summary_queue=None):
+        """
+        Creates a checkpoint writer, with its own graph and session on the
+        cpu holding a copy of the variables.
+
+        :param variables: The variables to checkpoint.
+        :param save_dir: The directory the checkpoints are written to, whose
+        checkpoint state file is kept up to date.
+        :param keep_recent: The number of most recent checkpoints to keep.
+        :param keep_every_n_hours: Additionally keep one checkpoint every
+        this many hours. If None, only the most recent are kept.
+        :param summary_queue: If not None, a queue of (summary, step) tuples
+        (see aquila_train._summary_worker) on which the time taken by each
+        write is reported.
+        :return: An instance of AsyncCheckpointer
+        """
+        self.variables = variables
+        self.save_dir = save_dir
+        self.keep_recent = keep_recent
+        self.keep_every_n_hours = keep_every_n_hours
+        self.summary_queue = summary_queue
+        self.graph = tf.Graph()
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            self.phds = []
+            assign_ops = []
+            for v in variables:
+                dtype = v.dtype.base_dtype
+                copy = tf.Variable(tf.zeros(v.get_shape(), dtype=dtype),
+                                   name=v.op.name, trainable=False)
+                phd = tf.placeholder(dtype, shape=v.get_shape())
+                assign_ops.append(copy.assign(phd))
+                self.phds.append(phd)
+            self.assign_op = tf.group(*assign_ops)
+            # retention is handled here, rather than by the saver
+            self.saver = tf.train.Saver(tf.all_variables(), max_to_keep=0)
+            init = tf.initialize_all_variables()
+        self.sess = tf.Session(graph=self.graph)
+        self.sess.run(init)
+        # the checkpoints on disk, as [path, kept permanently]
+        self.checkpoints = []
+        self.last_permanent = None
+        self._find_checkpoints()
+        # a snapshot waits here while the previous one is written
+        self.queue = Queue(maxsize=1)
+        self.thread = Thread(target=self._Writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, sess, save_path, global_step):
+        """
+        Snapshots the variables and queues them to be written. Blocks while
+        another snapshot is waiting to be written.
+
+        :param sess: The training session.
+        :param save_path: The prefix of the checkpoint's path.
+        :param global_step: The step, which is appended to save_path.
+        :return: The path the checkpoint will be written to.
+        """
+        values = sess.run(self.variables)
+        path = '%s-%d' % (save_path, global_step)
+        self.queue.put((values, path, global_step))
+        return path
+
+    def close(self):
+        """
+        Waits for the queued checkpoints to be written.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def _write(self, values, path):
+        """
+        Writes a checkpoint under a temporary name and renames it into place.
+        """
+        tmp_path = path + '.tmp'
+        self.sess.run(self.assign_op, feed_dict=dict(zip(self.phds, values)))
+        # a scratch state file, so the real one never names tmp_path
+        self.saver.save(self.sess, tmp_path,
+                        latest_filename='checkpoint.tmp')
+        os.rename(tmp_path, path)
+        if os.path.exists(tmp_path + '.meta'):
+            os.rename(tmp_path + '.meta', path + '.meta')
+
+    def _find_checkpoints(self):
+        """
+        Takes over the checkpoints listed in save_dir's checkpoint state
+        file, so that those of earlier runs are retained (and deleted) like
+        this run's. Which were kept permanently isn't recorded, so that is
+        decided again from their modification times.
+        """
+        state = tf.train.get_checkpoint_state(self.save_dir)
+        if state is None:
+            return
+        for path in state.all_model_checkpoint_paths:
+            if not os.path.isabs(path):
+                path = os.path.join(self.save_dir, path)
+            if not os.path.exists(path):
+                continue
+            mtime = os.path.getmtime(path)
+            permanent = (self.keep_every_n_hours is not None and
+                         (self.last_permanent is None or
+                          mtime - self.last_permanent >=
+                          self.keep_every_n_hours * 3600))
+            if permanent:
+                self.last_permanent = mtime
+            self.checkpoints.append([path, permanent])
+
+    def _retain(self, path):
+        """
+        Adds a checkpoint to those on disk, deleting those that are no longer
+        needed, and updates the checkpoint state file.
+        """
+        now = time.time()
+        permanent = (self.keep_every_n_hours is not None and
+                     (self.last_permanent is None or
+                      now - self.last_permanent >=
+                      self.keep_every_n_hours * 3600))
+        if permanent:
+            self.last_permanent = now
+        self.checkpoints.append([path, permanent])
+        recent = [x for x in self.checkpoints if not x[1]]
+        for old in recent[:max(len(recent) - self.keep_recent, 0)]:
+            for fn in [old[0]] + [old[0] + x for x in COMPANION_SUFFIXES]:
+                if os.path.exists(fn):
+                    os.remove(fn)
+            self.checkpoints.remove(old)
+        tf.train.update_checkpoint_state(self.save_dir, path,
+                                         [x[0] for x in self.checkpoints])
+
+    def _Writer(self):
+        """
+        Writer class method. Should be started as a thread.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            values, path, step = item
+            start = time.time()
+            self._write(values, path)
+            self._retain(path)
+            if self.summary_queue is not None:
+                summary = tf.Summary(value=[tf.Summary.Value(
+                    tag='checkpoint/write_seconds',
+                    simple_value=time.time() - start)])
+                self.summary_queue.put((summary, step))
+            print 'Wrote checkpoint %s (%.1f sec)' % (path,
+                                                     time.time() - start)
@@ -0,0 +1,198 @@
+"""
+Composes batches whose images have many known comparisons among themselves.
+
+Under single_win_mapping each image in a batch is compared to exactly one
+partner, so the [batch_size, batch_size] label matrix is almost entirely
+zero. The composer instead treats the win list as a graph, seeds each batch
+with a pair and greedily grows it with the images that have the most
+not-yet-used comparisons to the images already in the batch. The label
+matrix is then filled with every comparison among the batch's images.
+
+The TrialBatchComposer instead keeps the three images of each MTurk trial
+(and the two comparisons it yields) together.
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+class DenseBatchComposer(object):
+    def __init__(self, pairs, batch_size):
+        """
+        Creates a batch composer over a set of distinct pairs.
+
+        NOTES:
+            A pass over the data ends once every pair has been covered by
+            some batch, at which point the seed order is reshuffled.
+
+        :param pairs: An int array of shape [num_pairs, 4], where each row is
+        [a, b, wins_a_over_b, wins_b_over_a] (see _aggregate_win_list).
+        :param batch_size: The size of a batch.
+        :return: An instance of DenseBatchComposer
+        """
+        self.pairs = pairs
+        self.batch_size = batch_size
+        lo = pairs[:, 0]
+        hi = pairs[:, 1]
+        rows = np.concatenate((lo, hi))
+        cols = np.concatenate((hi, lo))
+        n = rows.max() + 1
+        if len(np.unique(rows)) < batch_size:
+            raise Exception('Fewer compared images than the batch size')
+        # a symmetric adjacency matrix, whose entries are the pair ids + 1
+        eid = np.arange(1, len(pairs) + 1, dtype=np.int32)
+        self.edges = sparse.csr_matrix(
+            (np.concatenate((eid, eid)), (rows, cols)), shape=(n, n))
+        # wins[i, j] = number of wins of i over j
+        self.wins = sparse.csr_matrix(
+            (np.concatenate((pairs[:, 2], pairs[:, 3])), (rows, cols)),
+            shape=(n, n))
+        self.batches_per_epoch = len(pairs) // (batch_size // 2)
+        self.reset()
+
+    def reset(self, rng=np.random):
+        """
+        Starts a new pass over the pairs.
+
+        :param rng: The random number generator (e.g., a RandomState) to
+        shuffle the seed pairs with.
+        :return: None
+        """
+        self.rng = rng
+        self.covered = np.zeros(len(self.pairs), dtype=bool)
+        self.order = np.zeros(0, dtype=np.int32)
+        self.pos = 0
+
+    def _next_seed(self):
+        """
+        Returns the next pair that has not yet been covered in this pass,
+        starting a new pass if need be.
+        """
+        while True:
+            if self.pos >= len(self.order):
+                self.covered[:] = False
+                self.order = np.arange(len(self.pairs), dtype=np.int32)
+                self.rng.shuffle(self.order)
+                self.pos = 0
+            e = self.order[self.pos]
+            self.pos += 1
+            if not self.covered[e]:
+                return self.pairs[e, 0], self.pairs[e, 1]
+
+    def _add(self, x, members, scores):
+        """
+        Adds an image to the batch being composed, and credits each of its
+        neighbours with its uncovered comparisons to it.
+        """
+        members.append(x)
+        scores.pop(x, None)
+        start, stop = self.edges.indptr[x], self.edges.indptr[x + 1]
+        for nb, e in zip(self.edges.indices[start:stop],
+                         self.edges.data[start:stop]):
+            if nb in members or self.covered[e - 1]:
+                continue
+            scores[nb] = scores.get(nb, 0) + 1
+
+    def next_batch(self):
+        """
+        Composes the next batch.
+
+        :return: A tuple (indices, labels), where indices is an int32 array
+        of the batch_size images in the batch and labels is their
+        [batch_size, batch_size] int32 win matrix.
+        """
+        members = []
+        scores = dict()
+        while len(members) < self.batch_size:
+            if scores:
+                self._add(max(scores, key=scores.get), members, scores)
+                continue
+            for x in self._next_seed():
+                if x not in members and len(members) < self.batch_size:
+                    self._add(x, members, scores)
+        indices = np.array(members, dtype=np.int32)
+        self.covered[self.edges[indices][:, indices].data - 1] = True
+        labels = self.wins[indices][:, indices].toarray().astype(np.int32)
+        return indices, labels
+
+
+class TrialBatchComposer(object):
+    def __init__(self, trials, batch_size):
+        """
+        Creates a batch composer over a list of trials, each of which
+        compared three images and yielded two comparisons (see
+        assembly/assemble_new_data.parse_blocks). Whole trials are packed
+        into each batch, so that each image is fed once for both of its
+        comparisons, and an image shared by several trials in a batch is fed
+        once for all of them.
+
+        NOTES:
+            Slots that no further trial fits in are filled with repeats of
+            the batch's images, which take part in no comparisons. A batch
+            holds at most one pass over the trials, so that a trial list
+            whose images all fit in one batch still yields batches.
+
+        :param trials: An int array of shape [num_trials, 4], where each row
+        is [win_1, lose_1, win_2, lose_2].
+        :param batch_size: The size of a batch, at least the number of
+        distinct images in any trial.
+        :return: An instance of TrialBatchComposer
+        """
+        most_images = max(len(set(trial)) for trial in trials)
+        if batch_size < most_images:
+            raise Exception('A batch of %i cannot hold a trial of %i images' %
+                            (batch_size, most_images))
+        self.trials = trials
+        self.batch_size = batch_size
+        self.batches_per_epoch = len(trials) // (batch_size // 3)
+        self.reset()
+
+    def reset(self, rng=np.random):
+        """
+        Starts a new pass over the trials.
+
+        :param rng: The random number generator (e.g., a RandomState) to
+        shuffle the trials with.
+        :return: None
+        """
+        self.rng = rng
+        self.order = np.zeros(0, dtype=np.int32)
+        self.pos = 0
+
+    def _peek_trial(self):
+        """
+        Returns the next trial, starting a new pass if need be, without
+        consuming it.
+        """
+        if self.pos >= len(self.order):
+            self.order = np.arange(len(self.trials), dtype=np.int32)
+            self.rng.shuffle(self.order)
+            self.pos = 0
+        return self.trials[self.order[self.pos]]
+
+    def next_batch(self):
+        """
+        Composes the next batch from as many of the upcoming trials as fit.
+
+        :return: A tuple (indices, labels), where indices is an int32 array
+        of the batch_size images in the batch and labels is their
+        [batch_size, batch_size] int32 win matrix.
+        """
+        slots = dict()
+        members = []
+        labels = np.zeros((self.batch_size, self.batch_size), dtype=np.int32)
+        for _ in xrange(len(self.trials)):
+            trial = self._peek_trial()
+            new = [x for x in set(trial) if x not in slots]
+            if len(members) + len(new) > self.batch_size:
+                break
+            self.pos += 1
+            for x in new:
+                slots[x] = len(members)
+                members.append(x)
+            labels[slots[trial[0]], slots[trial[1]]] += 1
+            labels[slots[trial[2]], slots[trial[3]]] += 1
+        num_images = len(members)
+        while len(members) < self.batch_size:
+            members.append(members[len(members) % num_images])
+        return np.array(members, dtype=np.int32), labels
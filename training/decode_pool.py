@@ -0,0 +1,131 @@
+"""
+A multiprocessing backend for the input manager. Rather than decoding and
+augmenting images inside the TensorFlow graph (one subgraph per batch
+element, driven from Python threads), the JPEGs are decoded, randomly cropped
+and randomly flipped by a pool of worker processes that write directly into
+shared-memory batch buffers. The feeder threads then hand the ready-made
+uint8 arrays to the queue.
+
+NOTES:
+    The pool forks its workers, so it should be created before the TensorFlow
+    session is.
+"""
+
+import os
+import numpy as np
+from PIL import Image
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+from Queue import Queue
+from training.augment import CROP_SIZE
+from training.augment import NUM_CHANNELS
+from training.augment import random_crop_flip
+
+# the shared batch buffers, as seen by the worker processes. These are
+# inherited when the pool forks.
+_buffers = None
+
+
+def _init_worker(buffers):
+    """
+    Initializes a pool worker process.
+
+    :param buffers: The list of shared batch buffers.
+    :return: None
+    """
+    global _buffers
+    _buffers = buffers
+    # otherwise every forked worker produces the same crops and flips.
+    np.random.seed((os.getpid() * 7919) % (2 ** 32))
+
+
+def _batch_view(buf, batch_size):
+    """
+    Returns a numpy view onto a shared batch buffer.
+
+    :param buf: A shared batch buffer.
+    :param batch_size: The size of a batch.
+    :return: A uint8 array of shape [batch_size, 299, 299, 3]
+    """
+    return np.frombuffer(buf, dtype=np.uint8).reshape(
+        [batch_size, CROP_SIZE, CROP_SIZE, NUM_CHANNELS])
+
+
+def _decode_into(args):
+    """
+    The pool task. Decodes a single JPEG and writes its augmented version into
+    a slot of a shared batch buffer.
+
+    :param args: A tuple (buffer index, batch size, slot, filename)
+    :return: None
+    """
+    buf_idx, batch_size, slot, fn = args
+    image = np.asarray(Image.open(fn).convert('RGB'))
+    random_crop_flip(image, _batch_view(_buffers[buf_idx], batch_size)[slot])
+
+
+class JpegDecodePool(object):
+    def __init__(self, filemap, imdir, batch_size, num_procs=4,
+                 num_buffers=8):
+        """
+        Creates a pool of processes that decode and augment batches of images
+        into shared memory.
+
+        :param filemap: A dictionary that maps indices to image filenames.
+        :param imdir: The directory that contains the input images.
+        :param batch_size: The size of a batch.
+        :param num_procs: The number of decoding processes to spawn.
+        :param num_buffers: The number of shared batch buffers. This bounds
+        the number of batches that may be in flight at once, and should be at
+        least the number of feeder threads.
+        :return: An instance of JpegDecodePool
+        """
+        self.filemap = filemap
+        self.imdir = imdir
+        self.batch_size = batch_size
+        self.num_procs = num_procs
+        buf_size = batch_size * CROP_SIZE * CROP_SIZE * NUM_CHANNELS
+        self.buffers = [RawArray('B', buf_size) for _ in range(num_buffers)]
+        self.free = Queue()
+        for n in range(num_buffers):
+            self.free.put(n)
+        self.pool = Pool(num_procs, initializer=_init_worker,
+                         initargs=(self.buffers,))
+
+    def load(self, indices):
+        """
+        Decodes and augments the images for a batch. Blocks until a batch
+        buffer is free and all the images have been written.
+
+        :param indices: The indices of the images in the batch.
+        :return: A tuple (handle, images), where images is a uint8 array of
+        shape [batch_size, 299, 299, 3] backed by shared memory. It remains
+        valid until release(handle) is called.
+        """
+        buf_idx = self.free.get()
+        tasks = [(buf_idx, self.batch_size, slot,
+                  os.path.join(self.imdir, self.filemap[x]))
+                 for slot, x in enumerate(indices)]
+        try:
+            self.pool.map(_decode_into, tasks)
+        except:
+            self.free.put(buf_idx)
+            raise
+        return buf_idx, _batch_view(self.buffers[buf_idx], self.batch_size)
+
+    def release(self, handle):
+        """
+        Returns a batch buffer to the pool once its contents have been fed to
+        TensorFlow.
+
+        :param handle: The handle returned by load.
+        :return: None
+        """
+        self.free.put(handle)
+
+    def close(self):
+        """
+        Terminates the worker processes.
+        """
+        self.pool.terminate()
+        self.pool.join()
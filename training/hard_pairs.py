@@ -0,0 +1,80 @@
+"""
+Loss-aware sampling of the pair index. The towers report the RankNet loss
+of the pairs they were fed (by row of the pair index), and pairs are drawn
+in proportion to their most recent loss, so that fewer steps are spent on
+pairs that the model already ranks confidently. The probabilities are
+recomputed periodically, within epochs as well as between.
+
+The draws are biased, so each pair also gets an importance weight that
+scales its labels. Since the RankNet loss is normalized by the sum of the
+labels, the weights act as a self-normalized correction within each batch.
+"""
+
+import numpy as np
+
+
+class HardPairSampler(object):
+    def __init__(self, num_pairs, alpha=1., beta=1., mix=0.1):
+        """
+        Creates a sampler over the rows of a pair index.
+
+        :param num_pairs: The number of rows in the pair index.
+        :param alpha: The exponent applied to the losses; 0 samples as if
+        every pair were equally hard.
+        :param beta: The exponent applied to the importance weights; 1 fully
+        corrects for the biased sampling, 0 not at all.
+        :param mix: The fraction of the draws made without regard to the
+        losses, so that no pair is starved.
+        :return: An instance of HardPairSampler
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.mix = mix
+        # the pairs that have not yet been seen are NaN
+        self.losses = np.empty(num_pairs, dtype=np.float32)
+        self.losses.fill(np.nan)
+
+    def report(self, rows, losses):
+        """
+        Records the most recent losses of some pairs. This is called from
+        the training loop, concurrently with epoch_probs.
+
+        :param rows: The rows of the pair index that were fed. Negative
+        rows are ignored, and repeated rows keep the last of their losses.
+        :param losses: The losses of the pairs.
+        :return: None
+        """
+        rows = np.asarray(rows)
+        valid = rows >= 0
+        self.losses[rows[valid]] = np.asarray(losses)[valid]
+
+    def epoch_probs(self, base_probs=None):
+        """
+        Computes the probability with which each pair is drawn next (e.g.,
+        in the next chunk of an epoch), and the importance weight of each
+        pair.
+
+        :param base_probs: The probabilities with which the pairs would be
+        drawn without regard to the losses. If None, uniform.
+        :return: A tuple (probs, weights), both float64 arrays of length
+        num_pairs. The weights have a mean of 1 under probs.
+        """
+        num_pairs = len(self.losses)
+        if base_probs is None:
+            base_probs = np.ones(num_pairs) / num_pairs
+        losses = self.losses.astype(np.float64)
+        seen = ~np.isnan(losses)
+        # as in prioritized replay, unseen pairs are treated as the hardest
+        if seen.any():
+            losses[~seen] = losses[seen].max()
+        else:
+            losses[:] = 1.
+        priority = base_probs * np.maximum(losses, 1e-6) ** self.alpha
+        probs = ((1. - self.mix) * priority / priority.sum() +
+                 self.mix * base_probs)
+        weights = (base_probs / probs) ** self.beta
+        weights /= np.dot(probs, weights)
+        print ('Hard pairs: %i of %i seen, mean loss %.3f, weights '
+               '%.2f-%.2f' % (seen.sum(), num_pairs, np.mean(losses),
+                              weights.min(), weights.max()))
+        return probs, weights
@@ -0,0 +1,139 @@
+"""
+A size-bounded LRU cache of decoded (pre-augmentation) images, shared by the
+feeder threads, and an input manager loader that uses it. Popular images
+appear in many pairs; with the cache they are decoded once and then only
+cropped and flipped each time they reappear.
+"""
+
+import os
+import numpy as np
+from PIL import Image
+from collections import OrderedDict
+from threading import Lock
+from training.augment import CROP_SIZE
+from training.augment import NUM_CHANNELS
+from training.augment import random_crop_flip
+
+
+class ImageCache(object):
+    def __init__(self, max_bytes):
+        """
+        Creates a thread-safe LRU cache of images with a byte budget.
+
+        :param max_bytes: The maximum total size of the cached images, in
+        bytes.
+        :return: An instance of ImageCache
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        """
+        Fetches an image, marking it as the most recently used.
+
+        :param key: The index of the image.
+        :return: The image, or None if it is not cached.
+        """
+        with self.lock:
+            image = self.entries.pop(key, None)
+            if image is None:
+                self.misses += 1
+                return None
+            self.entries[key] = image
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        """
+        Caches an image, evicting the least recently used images until the
+        cache is within its budget.
+
+        :param key: The index of the image.
+        :param image: The image, a numpy array.
+        :return: None
+        """
+        if image.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = image
+            self.num_bytes += image.nbytes
+            while self.num_bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.num_bytes -= old.nbytes
+
+    def __str__(self):
+        total = max(self.hits + self.misses, 1)
+        return ('%i images (%.1f MB), %i hits, %i misses (%.1f%% hit rate)' %
+                (len(self.entries), self.num_bytes / 2.**20, self.hits,
+                 self.misses, 100. * self.hits / total))
+
+
+class CachedJpegLoader(object):
+    def __init__(self, filemap, imdir, batch_size, max_bytes,
+                 report_every=1000):
+        """
+        Creates an input manager loader that decodes images in the feeder
+        threads, keeping the decoded images in an LRU cache.
+
+        :param filemap: A dictionary that maps indices to image filenames.
+        :param imdir: The directory that contains the input images.
+        :param batch_size: The size of a batch.
+        :param max_bytes: The byte budget of the cache.
+        :param report_every: Print the cache statistics every this many
+        batches.
+        :return: An instance of CachedJpegLoader
+        """
+        self.filemap = filemap
+        self.imdir = imdir
+        self.batch_size = batch_size
+        self.report_every = report_every
+        self.num_batches = 0
+        self.cache = ImageCache(max_bytes)
+
+    def _decode(self, idx):
+        """
+        Returns the decoded image for an index, from the cache if possible.
+        """
+        image = self.cache.get(idx)
+        if image is None:
+            fn = os.path.join(self.imdir, self.filemap[idx])
+            image = np.asarray(Image.open(fn).convert('RGB'))
+            self.cache.put(idx, image)
+        return image
+
+    def load(self, indices):
+        """
+        Decodes (at most once per distinct image) and augments the images for
+        a batch.
+
+        :param indices: The indices of the images in the batch.
+        :return: A tuple (handle, images), where images is a uint8 array of
+        shape [batch_size, 299, 299, 3]. The handle is unused.
+        """
+        decoded = dict((x, self._decode(x)) for x in set(indices))
+        images = np.empty([len(indices), CROP_SIZE, CROP_SIZE, NUM_CHANNELS],
+                          dtype=np.uint8)
+        for slot, x in enumerate(indices):
+            random_crop_flip(decoded[x], images[slot])
+        self.num_batches += 1
+        if not self.num_batches % self.report_every:
+            print 'Image cache: %s' % self.cache
+        return None, images
+
+    def release(self, handle):
+        """
+        Does nothing; the batches returned by load are not reused.
+        """
+        pass
+
+    def close(self):
+        """
+        Reports the final cache statistics.
+        """
+        print 'Image cache: %s' % self.cache
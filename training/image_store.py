@@ -0,0 +1,73 @@
+"""
+A memory-mapped store of pre-decoded images, as written by
+utility/build_image_store.py. Since the images have already been resized and
+padded to 314 x 314 (see utility/preproc_resize_pad.py), they may be stored
+as raw uint8 arrays and randomly cropped and flipped straight out of the
+page cache, with no decoding at all.
+
+The store is a directory of shards named shard_00000.npy, shard_00001.npy,
+... each holding an array of shape [shard_size, 314, 314, 3]. The image with
+index i (in the idx_2_id file) is row i % shard_size of shard i // shard_size.
+"""
+
+import os
+from glob import glob
+import numpy as np
+from training.augment import CROP_SIZE
+from training.augment import NUM_CHANNELS
+from training.augment import random_crop_flip
+
+
+class MmapImageStore(object):
+    def __init__(self, store_dir, batch_size):
+        """
+        Opens a memory-mapped image store for use as an input manager loader.
+
+        :param store_dir: The directory that contains the store's shards.
+        :param batch_size: The size of a batch.
+        :return: An instance of MmapImageStore
+        """
+        self.store_dir = store_dir
+        self.batch_size = batch_size
+        fns = sorted(glob(os.path.join(store_dir, 'shard_*.npy')))
+        if not fns:
+            raise Exception('No image store found in %s' % store_dir)
+        self.shards = [np.load(fn, mmap_mode='r') for fn in fns]
+        self.shard_size = len(self.shards[0])
+        self.num_images = sum(len(x) for x in self.shards)
+
+    def get(self, idx):
+        """
+        Returns a (read-only, memory-mapped) view of a stored image.
+
+        :param idx: The index of the image.
+        :return: A uint8 array of shape [314, 314, 3]
+        """
+        shard, row = divmod(idx, self.shard_size)
+        return self.shards[shard][row]
+
+    def load(self, indices):
+        """
+        Randomly crops and flips the images for a batch out of the store.
+
+        :param indices: The indices of the images in the batch.
+        :return: A tuple (handle, images), where images is a uint8 array of
+        shape [batch_size, 299, 299, 3]. The handle is unused.
+        """
+        images = np.empty([len(indices), CROP_SIZE, CROP_SIZE, NUM_CHANNELS],
+                          dtype=np.uint8)
+        for slot, x in enumerate(indices):
+            random_crop_flip(self.get(x), images[slot])
+        return None, images
+
+    def release(self, handle):
+        """
+        Does nothing; the batches returned by load are not reused.
+        """
+        pass
+
+    def close(self):
+        """
+        Drops the memory maps.
+        """
+        self.shards = []
@@ -5,93 +5,533 @@ resolutions are hardcoded here.
 
 import numpy as np
 import tensorflow as tf
+from scipy import sparse
 import os
+import json
+import zlib
+import time
+from collections import deque
+from itertools import cycle
 from threading import Thread
 from threading import Event
 from Queue import Queue
 from Queue import Empty as QueueEmpty
+from training.composer import DenseBatchComposer
+from training.composer import TrialBatchComposer
+from training.hard_pairs import HardPairSampler
 
 
 VERBOSE = False  # whether or not the print all the shit you're doing
 
+# the ways in which pairs may be drawn under single_win_mapping
+PAIR_SAMPLING_MODES = ('repeat', 'weighted', 'proportional')
 
-def get_enqueue_op(fn_phds, lab_phds, queue):
+# the way in which epoch orderings are derived from the seed. This must be
+# changed whenever _epoch_batches is, so old descriptors can't be misread.
+ORDER_ALGORITHM = 'randomstate-seed-plus-epoch-v1'
+
+
+def get_enqueue_op(fn_phd, lab_phd, queue, id_phd=None):
     """
     Obtains the TensorFlow batch enqueue operation.
 
-    :param fn_phds: Filename TensorFlow placeholders (size=[batch_size])
-    :param lab_phds: Label TensorFlow placeholders (size=[batch_size])
-    :param queue: The TensorFlow input queue.
-    :return: The enqueue operation.
+    NOTES:
+        decode_jpeg only operates on a single image, so the filename batch is
+        unpacked for decoding and cropping. The images are flipped as a batch.
+
+    :param fn_phd: Filename TensorFlow placeholder (size=[batch_size])
+    :param lab_phd: Label TensorFlow placeholder (size=[batch_size,
+    batch_size])
+    :param queue: The TensorFlow input queue, or a list of them (e.g., one
+    per tower), in which case a list of enqueue operations that share the
+    decoding is returned. Images are enqueued as whichever type (float32 or
+    uint8) the queue holds.
+    :param id_phd: If not None, a pair index row TensorFlow placeholder
+    (size=[batch_size]), whose values are enqueued alongside the images (see
+    HardPairSampler).
+    :return: The enqueue operation(s).
+    """
+    batch_size = fn_phd.get_shape()[0].value
+    # read in the raw jpegs
+    raw_ims = [tf.read_file(fn) for fn in tf.unpack(fn_phd, num=batch_size)]
+    return _enqueue_many(queue, _decode_crop_flip(raw_ims), lab_phd, id_phd)
+
+
+def get_encoded_enqueue_op(jpeg_phd, lab_phd, queue, id_phd=None):
+    """
+    Obtains the TensorFlow batch enqueue operation for images that are fed
+    as encoded JPEG bytes (e.g., by a PackedJpegStore) rather than as
+    filenames.
+
+    :param jpeg_phd: Encoded JPEG TensorFlow placeholder (size=[batch_size])
+    :param lab_phd: Label TensorFlow placeholder (size=[batch_size,
+    batch_size])
+    :param queue: The TensorFlow input queue, or a list of them.
+    :param id_phd: If not None, a pair index row placeholder (see
+    get_enqueue_op).
+    :return: The enqueue operation(s).
+    """
+    batch_size = jpeg_phd.get_shape()[0].value
+    raw_ims = tf.unpack(jpeg_phd, num=batch_size)
+    return _enqueue_many(queue, _decode_crop_flip(raw_ims), lab_phd, id_phd)
+
+
+def _decode_crop_flip(raw_ims):
+    """
+    Decodes, randomly crops and randomly flips a batch of JPEGs.
+
+    :param raw_ims: A list of scalar string tensors of encoded JPEGs.
+    :return: A uint8 tensor of shape [batch_size, 299, 299, 3]
     """
     im_tensors = []
-    im_labels = []
-    for fn_phd, lab_phd in zip(fn_phds, lab_phds):
-        # read in the raw jpeg
-        raw_im = tf.read_file(fn_phd)
+    for raw_im in raw_ims:
         # convert to jpeg
         jpeg_im = tf.image.decode_jpeg(raw_im, channels=3)
         # random crop the image
         cropped_im = tf.random_crop(jpeg_im, [299, 299, 3])
-        # random flip left/right
-        im_tensor = tf.image.random_flip_left_right(cropped_im)
-        im_tensors.append(tf.to_float(im_tensor))
-        im_labels.append(tf.to_float(lab_phd))
-    packed_ims = tf.pack(im_tensors)
-    packed_labels = tf.pack(im_labels)
-    enq_op = queue.enqueue_many([packed_ims, packed_labels])
-    return enq_op
+        # random flip left/right, per image, since Select can't broadcast a
+        # per-image condition over the batch
+        im_tensors.append(tf.image.random_flip_left_right(cropped_im))
+    return tf.pack(im_tensors)
+
+
+def get_array_enqueue_op(im_phd, lab_phd, queue, id_phd=None):
+    """
+    Obtains the TensorFlow batch enqueue operation for images that have
+    already been decoded and augmented outside of TensorFlow (i.e., by a
+    loader).
+
+    :param im_phd: A uint8 image placeholder (size=[batch_size, 299, 299, 3])
+    :param lab_phd: A label placeholder (size=[batch_size, batch_size])
+    :param queue: The TensorFlow input queue, or a list of them. Images are
+    enqueued as whichever type (float32 or uint8) the queue holds.
+    :param id_phd: If not None, a pair index row placeholder (see
+    get_enqueue_op).
+    :return: The enqueue operation(s).
+    """
+    return _enqueue_many(queue, im_phd, lab_phd, id_phd)
+
+
+def _enqueue_many(queue, images, labels, ids=None):
+    """
+    Creates the enqueue operation(s) for a batch of images and labels.
 
+    :param queue: The TensorFlow input queue, or a list of them.
+    :param images: The batch of images.
+    :param labels: The [batch_size, batch_size] labels.
+    :param ids: If not None, the [batch_size] pair index rows of the images,
+    which the queue must have a third (int32) component for.
+    :return: The enqueue operation, or a list of them if given a list of
+    queues.
+    """
+    if isinstance(queue, list):
+        return [_enqueue_many(q, images, labels, ids) for q in queue]
+    tensors = [tf.cast(images, queue.dtypes[0]), tf.to_float(labels)]
+    if ids is not None:
+        tensors.append(ids)
+    return queue.enqueue_many(tensors)
+
+
+def _expand_win_list(win_list):
+    """
+    Expands a win list into an array of pairs, where each pair (a, b) is
+    repeated once for every win of a over b.
+
+    :param win_list: A list or N x 3 array of the form [a, b, wins_a_over_b]
+    :return: An int32 array of shape [sum(wins), 2]
+    """
+    win_list = np.asarray(win_list, dtype=np.int32).reshape(-1, 3)
+    return np.repeat(win_list[:, :2], win_list[:, 2], axis=0)
+
+
+def _aggregate_win_list(win_list):
+    """
+    Collapses a win list into one entry per distinct (unordered) pair of
+    items, carrying the win counts in both directions.
+
+    :param win_list: A list or N x 3 array of the form [a, b, wins_a_over_b]
+    :return: An int32 array of shape [num_pairs, 4], where each row is
+    [a, b, wins_a_over_b, wins_b_over_a] and a < b.
+    """
+    win_list = np.asarray(win_list, dtype=np.int32).reshape(-1, 3)
+    win_list = win_list[win_list[:, 2] > 0]
+    lo = np.minimum(win_list[:, 0], win_list[:, 1]).astype(np.int64)
+    hi = np.maximum(win_list[:, 0], win_list[:, 1]).astype(np.int64)
+    n = hi.max() + 1
+    keys, inv = np.unique(lo * n + hi, return_inverse=True)
+    fwd = np.where(win_list[:, 0] == lo, win_list[:, 2], 0)
+    rev = np.where(win_list[:, 0] == lo, 0, win_list[:, 2])
+    pairs = np.zeros((len(keys), 4), dtype=np.int32)
+    pairs[:, 0] = keys // n
+    pairs[:, 1] = keys % n
+    pairs[:, 2] = np.bincount(inv, weights=fwd, minlength=len(keys))
+    pairs[:, 3] = np.bincount(inv, weights=rev, minlength=len(keys))
+    return pairs
+
+
+def _build_pair_index(win_list, pair_sampling):
+    """
+    Builds the pair index that the manager thread iterates over each epoch.
+
+    :param win_list: A list or N x 3 array of the form [a, b, wins_a_over_b]
+    :param pair_sampling: One of PAIR_SAMPLING_MODES.
+    :return: A tuple (idxs, probs). idxs is an int32 array of rows (a, b)
+    or, for 'weighted', (a, b, wins_a_over_b, wins_b_over_a). probs is None
+    unless rows are to be drawn with replacement with the given probabilities.
+    """
+    if pair_sampling not in PAIR_SAMPLING_MODES:
+        raise Exception('Unknown pair sampling mode %s' % pair_sampling)
+    if pair_sampling == 'repeat':
+        return _expand_win_list(win_list), None
+    if pair_sampling == 'weighted':
+        return _aggregate_win_list(win_list), None
+    win_list = np.asarray(win_list, dtype=np.int32).reshape(-1, 3)
+    win_list = win_list[win_list[:, 2] > 0]
+    probs = win_list[:, 2].astype(np.float64)
+    return win_list[:, :2].copy(), probs / probs.sum()
+
+
+def _epoch_order(num_rows, probs=None, rng=np.random):
+    """
+    Returns the order in which the rows of the pair index are visited in an
+    epoch.
+
+    :param num_rows: The number of rows in the pair index.
+    :param probs: If not None, rows are drawn with replacement with these
+    probabilities rather than permuted.
+    :param rng: The random number generator (e.g., a RandomState) to use.
+    :return: An int32 array of row indices of length num_rows.
+    """
+    if probs is None:
+        # shuffle a permutation of row indices rather than the (much larger)
+        # pair array itself.
+        order = np.arange(num_rows, dtype=np.int32)
+        rng.shuffle(order)
+        return order
+    return rng.choice(num_rows, size=num_rows, p=probs).astype(np.int32)
 
-def _worker(win_matrix, filemap, imdir, batch_size, inq, outq, fn_phds,
-            lab_phds, enq_op, sess):
+
+def _save_input_state(path, state):
+    """
+    Atomically writes the state of an input manager to a JSON file.
+
+    :param path: The file to write.
+    :param state: A dictionary of the state.
+    :return: None
+    """
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(path + '.tmp', path)
+
+
+def _load_input_state(path):
+    """
+    Reads the state of an input manager written by _save_input_state.
+
+    :param path: The file to read.
+    :return: A dictionary of the state.
+    """
+    with open(path, 'r') as f:
+        state = json.load(f)
+    print 'Resuming input at epoch %i, batch %i (seed %i)' % (
+        state['epoch'], state['offset'], state['seed'])
+    return state
+
+
+def _locality_order(order, idxs, locality, rng):
+    """
+    Reorders a shuffled epoch so that reads are (mostly) sequential on disk,
+    while remaining statistically random. The shuffled epoch is cut into
+    large chunks; within each chunk the pairs are sorted by the on-disk
+    position of their first image, and then shuffled again only within a
+    bounded window. Each window is thus a random sample of the epoch that
+    touches a narrow region of the disk.
+
+    :param order: The shuffled order of the rows of idxs.
+    :param idxs: The pair index.
+    :param locality: A tuple (positions, chunk_size, buffer_size), where
+    positions maps image indices to their (relative) on-disk positions.
+    :param rng: The random number generator (e.g., a RandomState) to use.
+    :return: The reordered order.
+    """
+    positions, chunk_size, buffer_size = locality
+    keys = positions[idxs[order, 0]]
+    for start in xrange(0, len(order), chunk_size):
+        stop = min(start + chunk_size, len(order))
+        chunk = order[start:stop][np.argsort(keys[start:stop],
+                                             kind='mergesort')]
+        for window in xrange(0, len(chunk), buffer_size):
+            rng.shuffle(chunk[window:window + buffer_size])
+        order[start:stop] = chunk
+    return order
+
+
+def _epoch_batches(idxs, probs, seed, epoch, batch_size, composer=None,
+                   offset=0, locality=None):
+    """
+    Generates the batches of an epoch, in the order in which they are
+    dispatched. The ordering depends only on the arguments, so any epoch may
+    be regenerated from its seed (see replay_epoch_batches).
+
+    :param idxs: The pair index.
+    :param probs: The probabilities with which pairs are drawn, or None.
+    :param seed: The input manager's seed.
+    :param epoch: The epoch.
+    :param batch_size: The size of a batch.
+    :param composer: If not None, the DenseBatchComposer (or
+    TrialBatchComposer) to use.
+    :param offset: The number of batches at the start of the epoch to skip.
+    :param locality: If not None, the epoch is reordered for disk locality
+    (see _locality_order). Ignored with a composer.
+    :return: A generator of blocks of batch_size / 2 rows of idxs or, with a
+    composer, of (indices, labels) tuples.
+    """
+    block_size = batch_size // 2
+    rng = np.random.RandomState(seed + epoch)
+    if composer is not None:
+        # composition is sequential, so skipping batches means composing (and
+        # discarding) them.
+        composer.reset(rng)
+        for n in xrange(composer.batches_per_epoch):
+            batch = composer.next_batch()
+            if n >= offset:
+                yield batch
+        return
+    # pairs are dispatched a batch at a time; the remainder of each epoch
+    # that doesn't fill a batch is dropped.
+    order = _epoch_order(len(idxs), probs, rng)
+    if locality is not None:
+        order = _locality_order(order, idxs, locality, rng)
+    for start in xrange(offset * block_size, len(order) - block_size + 1,
+                        block_size):
+        yield idxs[order[start:start + block_size]]
+
+
+def _shard_blocks(blocks, offset, num_shards, shard_index, num_blocks):
+    """
+    Filters an epoch's blocks down to one shard's: every num_shards-th one,
+    starting from shard_index.
+
+    :param blocks: The blocks of the epoch, from offset * num_shards on.
+    :param offset: The number of the shard's batches that were skipped.
+    :param num_shards: The number of shards.
+    :param shard_index: The shard.
+    :param num_blocks: The number of blocks of the epoch to shard; the rest
+    are dropped, so that every shard has as many.
+    :return: A generator of blocks.
+    """
+    for n, block in enumerate(blocks, offset * num_shards):
+        if n >= num_blocks:
+            return
+        if n % num_shards == shard_index:
+            yield block
+
+
+def _checksum(arr):
+    """
+    Returns the CRC32 of an array's contents.
+    """
+    return zlib.crc32(np.ascontiguousarray(arr).data) & 0xffffffff
+
+
+def _order_descriptor(idxs, seed, batch_size, locality=None, **kwargs):
+    """
+    Describes how an input manager orders its epochs, so that any epoch's
+    ordering may be regenerated later rather than saved.
+
+    :param idxs: The pair index.
+    :param seed: The input manager's seed.
+    :param batch_size: The size of a batch.
+    :param locality: The locality options, if any (see _locality_order).
+    :param kwargs: The options with which the pair index was built. If they
+    include batches_per_epoch, it overrides that of a pair index.
+    :return: A dictionary.
+    """
+    desc = dict(kwargs)
+    desc['locality'] = None
+    if locality is not None:
+        positions, chunk_size, buffer_size = locality
+        desc['locality'] = [chunk_size, buffer_size, _checksum(positions)]
+    desc['algorithm'] = ORDER_ALGORITHM
+    desc['seed'] = seed
+    desc['batch_size'] = batch_size
+    desc['num_rows'] = len(idxs)
+    desc.setdefault('batches_per_epoch', len(idxs) // (batch_size // 2))
+    desc['checksum'] = _checksum(idxs)
+    return desc
+
+
+def _write_order_descriptor(debug_dir, epoch, desc):
+    """
+    Records an epoch's ordering as its (tiny) descriptor.
+
+    :param debug_dir: The directory to write to.
+    :param epoch: The epoch.
+    :param desc: The descriptor returned by _order_descriptor.
+    :return: None
+    """
+    desc = dict(desc)
+    desc['epoch'] = epoch
+    with open(os.path.join(debug_dir, 'epoch_%i.json' % epoch), 'w') as f:
+        json.dump(desc, f)
+
+
+def replay_epoch_batches(desc, win_data, epoch, offset=0,
+                         file_positions=None):
+    """
+    Regenerates the batches of an epoch exactly as an input manager
+    dispatched them.
+
+    :param desc: An epoch descriptor written to the debug_dir of an input
+    manager (a dictionary).
+    :param win_data: The win list (for InputManagerWinList) or win matrix
+    (for InputManager) the input manager was created with, or its trial
+    list if it had one.
+    :param epoch: The epoch.
+    :param offset: The number of batches at the start of the epoch to skip.
+    If the input manager was one of several shards, these are batches of
+    its shard.
+    :param file_positions: The file positions the input manager was given,
+    if any.
+    :return: A generator of batches (see _epoch_batches).
+    """
+    if desc['algorithm'] != ORDER_ALGORITHM:
+        raise Exception('Cannot replay orderings made by %s' %
+                        desc['algorithm'])
+    probs = None
+    composer = None
+    if desc['source'] == 'win_matrix':
+        win_data = sparse.csr_matrix(win_data)
+        a, b = win_data.nonzero()
+        if not desc['single_win_mapping']:
+            idxs = np.column_stack((a, b)).astype(np.int32)
+        else:
+            w = np.asarray(win_data[a, b]).ravel()
+            idxs, probs = _build_pair_index(np.column_stack((a, b, w)),
+                                            desc['pair_sampling'])
+    elif desc.get('trial_batches'):
+        idxs = np.asarray(win_data, dtype=np.int32).reshape(-1, 4)
+        composer = TrialBatchComposer(idxs, desc['batch_size'])
+    elif desc['dense_batches']:
+        idxs, _ = _build_pair_index(win_data, 'weighted')
+        composer = DenseBatchComposer(idxs, desc['batch_size'])
+    else:
+        idxs, probs = _build_pair_index(win_data, desc['pair_sampling'])
+    if _checksum(idxs) != desc['checksum']:
+        raise Exception('The win data differs from that used in training')
+    locality = None
+    if desc.get('locality') is not None:
+        chunk_size, buffer_size, checksum = desc['locality']
+        if file_positions is None or _checksum(file_positions) != checksum:
+            raise Exception('The file positions used in training are needed')
+        locality = (file_positions, chunk_size, buffer_size)
+    num_shards = desc.get('num_shards', 1)
+    blocks = _epoch_batches(idxs, probs, desc['seed'], epoch,
+                            desc['batch_size'], composer,
+                            offset * num_shards, locality)
+    if num_shards == 1:
+        return blocks
+    return _shard_blocks(blocks, offset, num_shards, desc['shard_index'],
+                         desc['batches_per_epoch'])
+
+
+def _pair_labels(block, batch_size):
+    """
+    Builds the label matrix for a batch made of a block of pairs, where the
+    pair in row k of the block occupies batch positions 2k and 2k + 1.
+
+    :param block: An int array of rows (i, j), meaning i beat j once, or
+    (i, j, wins_i_over_j, wins_j_over_i).
+    :param batch_size: The size of a batch.
+    :return: A [batch_size, batch_size] int32 label matrix.
+    """
+    labels = np.zeros((batch_size, batch_size), dtype=np.int32)
+    rows = np.arange(0, 2 * len(block), 2)
+    labels[rows, rows + 1] = block[:, 2] if block.shape[1] > 2 else 1
+    if block.shape[1] > 3:
+        labels[rows + 1, rows] = block[:, 3]
+    return labels
+
+
+def _enqueue_batch(indices, labels, filemap, imdir, fn_phd, lab_phd,
+                   enq_op, sess, loader=None, ids=None, id_phd=None):
+    """
+    Feeds a single batch to the TensorFlow enqueue operation.
+
+    :param indices: The indices of the images in the batch.
+    :param labels: The [batch_size, batch_size] label matrix.
+    :param filemap: A dictionary that maps indices to image filenames.
+    :param imdir: The directory that contains the input images.
+    :param fn_phd: The filename TensorFlow placeholder, or the image
+    placeholder if a loader is given.
+    :param lab_phd: The label TensorFlow placeholder.
+    :param enq_op: A tensorflow enqueue operation.
+    :param sess: A TensorFlow session manager.
+    :param loader: If not None, an object (such as a JpegDecodePool) whose
+    load(indices) returns (handle, images) and whose release(handle) frees
+    the images once they have been enqueued. The images are whatever the
+    placeholder takes (e.g., encoded JPEGs for a PackedJpegStore).
+    :param ids: The pair index rows of the images, if id_phd is given.
+    :param id_phd: If not None, the pair index row TensorFlow placeholder.
+    :return: None
+    """
+    if loader is None:
+        handle = None
+        data = [os.path.join(imdir, filemap[x]) for x in indices]
+    else:
+        handle, data = loader.load(indices)
+    if VERBOSE:
+        print 'Enqueuing', len(indices), 'examples'
+    feed_dict = {fn_phd: data, lab_phd: labels}
+    if id_phd is not None:
+        feed_dict[id_phd] = ids
+    try:
+        sess.run(enq_op, feed_dict=feed_dict)
+    finally:
+        if loader is not None:
+            loader.release(handle)
+
+
+def _worker(win_matrix, filemap, imdir, batch_size, inq, outq, fn_phd,
+            lab_phd, enq_ops, sess):
     """
     The target of the worker threads. Manages the actual execution of the
     enqueuing of data.
 
-    :param win_matrix: A sparse matrix or array X where X[i,j] = number
-    of wins of item i over item j.
+    :param win_matrix: A CSR matrix X where X[i,j] = number of wins of item
+    i over item j.
     :param filemap: A dictionary that maps indices to image filenames.
     :param imdir: The directory that contains the input images.
     :param batch_size: The size of a batch.
     :param inq: An input queue that stores the indicies of datapoints to
-    measure. The input queue consists of tuples of indices (i, j).
+    measure. The input queue consists of blocks of batch_size / 2 index
+    pairs (i, j), one block per batch.
     :param outq: The TensorFlow output queue.
-    :param fn_phds: Filename TensorFlow placeholders.
-    :param lab_phds: Label TensorFlow placeholders.
-    :param enq_op: A tensorflow enqueue operation.
+    :param fn_phd: Filename TensorFlow placeholder.
+    :param lab_phd: Label TensorFlow placeholder.
+    :param enq_ops: A (shared) cycle over the tensorflow enqueue operations,
+    one per output queue. Successive batches go to successive queues.
     :param sess: A TensorFlow session manager.
     :return: None
     """
-    # get the enqueue operation
     # iterate until the queue is empty
-    indices = np.zeros(batch_size).astype(int)
     while True:
-        for sidx in np.arange(0, batch_size, 2):
-            try:
-                idx1, idx2 = inq.get(True, 30)
-                indices[sidx] = idx1
-                indices[sidx + 1] = idx2
-            except QueueEmpty:
-                if VERBOSE:
-                    print 'Queue is empty, terminating'
-                return
-        image_fns = [os.path.join(imdir, filemap[x]) for x in indices]
-        image_labels = [win_matrix[x, indices].todense().A.squeeze() for x in
-                        indices]
-        feed_dict = dict()
-        # populate the feeder dictionary
-        for fnp, fnd, labp, labd in zip(fn_phds, image_fns, lab_phds,
-                                        image_labels):
-            feed_dict[fnp] = fnd
-            feed_dict[labp] = labd
-        if VERBOSE:
-            print 'Enqueuing', batch_size, 'examples'
-        sess.run(enq_op, feed_dict=feed_dict)
+        try:
+            block = inq.get(True, 30)
+        except QueueEmpty:
+            if VERBOSE:
+                print 'Queue is empty, terminating'
+            return
+        indices = block[:, :2].ravel()
+        image_labels = win_matrix[indices][:, indices].toarray()
+        _enqueue_batch(indices, image_labels, filemap, imdir, fn_phd,
+                       lab_phd, next(enq_ops), sess)
 
 
 def _single_win_map_worker(filemap, imdir, batch_size, inq, outq,
-                           fn_phds, lab_phds, enq_op, sess):
+                           fn_phd, lab_phd, enq_ops, sess, loader=None,
+                           stop=None, batch_times=None, id_phd=None,
+                           dispatched=None):
     """
     The target of the worker threads. Manages the actual execution of the
     enqueuing of data. This worker is responsible for working under the
@@ -101,50 +541,67 @@ def _single_win_map_worker(filemap, imdir, batch_size, inq, outq,
     :param imdir: The directory that contains the input images.
     :param batch_size: The size of a batch.
     :param inq: An input queue that stores the indicies of datapoints to
-    measure. The input queue consists of tuples of indices (i, j).
+    measure. The input queue consists of blocks of batch_size / 2 rows
+    (i, j), meaning i beat j once, or (i, j, wins_i_over_j, wins_j_over_i),
+    one block per batch. A block may also be a ready-made tuple (indices,
+    labels) (see DenseBatchComposer), or (indices, labels, ids) (see
+    HardPairSampler).
     :param outq: The TensorFlow output queue.
-    :param fn_phds: Filename TensorFlow placeholders.
-    :param lab_phds: Label TensorFlow placeholders.
-    :param enq_op: A tensorflow enqueue operation.
+    :param fn_phd: Filename TensorFlow placeholder, or the image placeholder
+    if a loader is given.
+    :param lab_phd: Label TensorFlow placeholder.
+    :param enq_ops: A (shared) cycle over the tensorflow enqueue operations,
+    one per output queue. Successive batches go to successive queues.
     :param sess: A TensorFlow session manager.
+    :param loader: If not None, decodes and augments the images outside of
+    TensorFlow (see _enqueue_batch).
+    :param stop: If not None, an Event that retires the worker once set.
+    :param batch_times: If not None, a collection to which the time taken by
+    each batch is appended.
+    :param id_phd: If not None, the pair index row TensorFlow placeholder.
+    Images whose block does not carry their rows are fed a row of -1.
+    :param dispatched: If not None, an Event that is set once every block
+    has been put on inq. Until then, the worker waits out an empty inq (e.g.,
+    while the manager skips to a resumed position) rather than terminating.
     :return: None
     """
-    indices = np.zeros(batch_size).astype(int)
-    while True:
-        image_labels = []
-        for sidx in np.arange(0, batch_size, 2):
-            try:
-                idx1, idx2 = inq.get(True, 30)
-                indices[sidx] = idx1
-                indices[sidx + 1] = idx2
-            except QueueEmpty:
-                if VERBOSE:
-                    print 'Queue is empty, terminating'
-                return
-            labs = np.zeros(batch_size).astype(int)
-            labs[sidx + 1] = 1
-            image_labels.append(labs)
-            image_labels.append(np.zeros(batch_size).astype(int))
-        image_fns = [os.path.join(imdir, filemap[x]) for x in indices]
-        feed_dict = dict()
-        # populate the feeder dictionary
-        for fnp, fnd, labp, labd in zip(fn_phds, image_fns, lab_phds,
-                                        image_labels):
-            feed_dict[fnp] = fnd
-            feed_dict[labp] = labd
-        if VERBOSE:
-            print 'Enqueuing', batch_size, 'examples'
-        sess.run(enq_op, feed_dict=feed_dict)
+    while stop is None or not stop.is_set():
+        try:
+            block = inq.get(True, 30)
+        except QueueEmpty:
+            if dispatched is not None and not dispatched.is_set():
+                continue
+            if VERBOSE:
+                print 'Queue is empty, terminating'
+            return
+        start = time.time()
+        ids = None
+        if isinstance(block, tuple) and len(block) == 3:
+            indices, image_labels, ids = block
+        elif isinstance(block, tuple):
+            indices, image_labels = block
+        else:
+            indices = block[:, :2].ravel()
+            image_labels = _pair_labels(block, batch_size)
+        if id_phd is not None and ids is None:
+            ids = -np.ones(batch_size, dtype=np.int32)
+        _enqueue_batch(indices, image_labels, filemap, imdir, fn_phd,
+                       lab_phd, next(enq_ops), sess, loader, ids, id_phd)
+        if batch_times is not None:
+            batch_times.append(time.time() - start)
 
 
 class InputManager(object):
     def __init__(self, win_matrix, filemap,
-                 imdir, tf_out, fn_phds,
-                 lab_phds, enq_op,
+                 imdir, tf_out, fn_phd,
+                 lab_phd, enq_op,
                  batch_size, num_epochs=100,
                  num_threads=4,
                  debug_dir=None,
-                 single_win_mapping=False):
+                 single_win_mapping=False,
+                 pair_sampling='repeat',
+                 seed=None,
+                 resume_from=None):
         """
         Creates an object that manages the input to TensorFlow by managing a
         set of threads that enqueue batches of images. Handles all shuffling
@@ -158,70 +615,110 @@ class InputManager(object):
         of wins of item i over item j.
         :param filemap: A dictionary that maps indices to image filenames.
         :param imdir: The directory that contains the input images.
-        :param tf_out: The FIFO output queue.
-        :param fn_phds: A list of TensorFlow placeholders of len batch_size
-        (type: (tf.string, shape=[]))
-        :param lab_phds: A list of TensorFlow placeholders of len batch_size
-        (type: (tf.int32, shape=[batch_size]))
-        :param enq_op: The TensorFlow enqueue operation.
+        :param tf_out: The FIFO output queue, or a list of them (e.g., one
+        per tower), in which case batches are spread over them round-robin.
+        :param fn_phd: The filename TensorFlow placeholder (type: (tf.string,
+        shape=[batch_size]))
+        :param lab_phd: The label TensorFlow placeholder (type: (tf.int32,
+        shape=[batch_size, batch_size]))
+        :param enq_op: The TensorFlow enqueue operation, or a list of them
+        (one per output queue).
         :param batch_size: The size of a batch.
         :param num_epochs: The number of epochs to run for.
         :param num_threads: The number of threads to spawn.
-        :param debug_dir: If not None, it will store the ordering in which it
-        stores the ordering of the inputs per epoch so errors may be re-created.
+        :param debug_dir: If not None, it will store a descriptor of the
+        ordering of the inputs per epoch so errors may be re-created (see
+        replay_epoch_batches and utility/replay_input_order.py).
         :param single_win_mapping: If True, then it will repeatedly enqueue
         items about which we have more data.
+        :param pair_sampling: How pairs are drawn under single_win_mapping.
+        'repeat' enqueues a pair once per win, 'weighted' enqueues each
+        distinct pair once per epoch with its win counts (in both directions)
+        as the labels, and 'proportional' draws pairs with replacement with
+        probability proportional to their win counts, one draw per distinct
+        pair per epoch.
+        :param seed: The seed from which every epoch's ordering is derived. If
+        None, one is chosen at random.
+        :param resume_from: If not None, a state file written by save_state,
+        from whose position (and seed) the input resumes.
         :return: An instance of InputManager
         """
-        self.win_matrix = win_matrix
+        # the workers slice [batch_size, batch_size] blocks out of the win
+        # matrix, which is only fast in CSR.
+        self.win_matrix = sparse.csr_matrix(win_matrix)
         self.filemap = filemap
         self.imdir = imdir
         self.batch_size = batch_size
         self.num_epochs = num_epochs
-        self.outq = tf_out
-        self.inq = Queue(maxsize=1024)
+        self.outqs = tf_out if isinstance(tf_out, list) else [tf_out]
+        self.outq = self.outqs[0]
+        self.inq = Queue(maxsize=128)
         self.num_threads = num_threads
-        self.fn_phds = fn_phds
-        self.lab_phds = lab_phds
-        self.enq_op = enq_op
+        self.fn_phd = fn_phd
+        self.lab_phd = lab_phd
+        self.enq_ops = enq_op if isinstance(enq_op, list) else [enq_op]
         self.num_threads = num_threads
         self.debug_dir = debug_dir
         self.single_win_mapping = single_win_mapping
+        self.pair_sampling = pair_sampling
         a, b = self.win_matrix.nonzero()
         # self.idxs = filter(lambda x: x[0] < x[1], zip(a, b))
         # why was i doing this? ^^^
         # self.idxs = zip(a[:16], b[:16])
         print 'Allocating indices'
+        self.probs = None
         if not single_win_mapping:
-            self.idxs = zip(a, b)
+            self.idxs = np.column_stack((a, b)).astype(np.int32)
         else:
-            self.idxs = []
-            for a_, b_ in zip(a, b):
-                if not win_matrix[a_, b_]:
-                    print 'GERROR!'
-                    return
-                for _ in range(self.win_matrix[a_, b_]):
-                    self.idxs.append([a_, b_])
+            w = np.asarray(self.win_matrix[a, b]).ravel()
+            self.idxs, self.probs = _build_pair_index(
+                np.column_stack((a, b, w)), pair_sampling)
         self.num_ex_per_epoch = len(self.idxs) * 2  # each entails 2 examples
+        self.batches_per_epoch = len(self.idxs) // (batch_size // 2)
+        self.seed = seed
+        if self.seed is None:
+            self.seed = np.random.randint(2**31 - 1)
+        self.start_epoch = 0
+        self.start_offset = 0
+        self.start_step = 0
+        if resume_from is not None:
+            state = _load_input_state(resume_from)
+            self.seed = state['seed']
+            self.start_epoch = state['epoch']
+            self.start_offset = state['offset']
+            self.start_step = state['step'] + 1
+        # the number of batches consumed before the input resumed
+        self.start_batches = (self.start_epoch * self.batches_per_epoch +
+                              self.start_offset)
+        if self.debug_dir is not None:
+            self.order_desc = _order_descriptor(
+                self.idxs, self.seed, batch_size, source='win_matrix',
+                single_win_mapping=single_win_mapping,
+                pair_sampling=pair_sampling, dense_batches=False)
         self.n_examples = 0
         self.should_stop = Event()
         self.mgr_thread = Thread(target=self._Mgr)
         self.mgr_thread.start()
         print 'Manager thread started'
 
-    def start(self, sess):
+    def start(self, sess, summary_queue=None, global_step=None):
         """
         Create & Starts all the threads
+
+        :param sess: A TensorFlow session manager.
+        :param summary_queue: Unused (see InputManagerWinList.start).
+        :param global_step: Unused.
         """
         if self.single_win_mapping:
             targ = _single_win_map_worker
             args = (self.filemap, self.imdir, self.batch_size, self.inq, 
-                    self.outq, self.fn_phds, self.lab_phds, self.enq_op, sess)
+                    self.outq, self.fn_phd, self.lab_phd,
+                    cycle(self.enq_ops), sess)
         else:
             targ = _worker
             args = (self.win_matrix, self.filemap, self.imdir, self.batch_size,
-                    self.inq, self.outq, self.fn_phds, self.lab_phds, 
-                    self.enq_op, sess)
+                    self.inq, self.outq, self.fn_phd, self.lab_phd, 
+                    cycle(self.enq_ops), sess)
         self.threads = [Thread(target=targ, args=args)
                         for _ in range(self.num_threads)]
         for t in self.threads:
@@ -240,18 +737,37 @@ class InputManager(object):
         """
         return self.should_stop.is_set()
 
+    def save_state(self, path, step, num_batches):
+        """
+        Saves the position of the input, so that it may be resumed (see
+        resume_from).
+
+        :param path: The file to write.
+        :param step: The last training step that was run.
+        :param num_batches: The total number of batches that have been
+        consumed by training, across all epochs.
+        :return: None
+        """
+        epoch, offset = divmod(num_batches, self.batches_per_epoch)
+        _save_input_state(path, {'seed': self.seed, 'epoch': epoch,
+                                 'offset': offset, 'step': step})
+
     def _Mgr(self):
         """
         Manager class method. Should be started as a thread.
         """
-        for epoch in range(self.num_epochs):
-            np.random.shuffle(self.idxs)
+        block_size = self.batch_size // 2
+        for epoch in range(self.start_epoch, self.num_epochs):
+            offset = 0
+            if epoch == self.start_epoch:
+                offset = self.start_offset
             if self.debug_dir is not None:
-                fn = os.path.join(self.debug_dir, 'epoch_%i' % epoch)
-                np.save(fn, self.idxs)
-            for idxs_pair in self.idxs:
-                self.inq.put(idxs_pair)
-                self.n_examples += 1
+                _write_order_descriptor(self.debug_dir, epoch, self.order_desc)
+            for block in _epoch_batches(self.idxs, self.probs, self.seed,
+                                        epoch, self.batch_size,
+                                        None, offset):
+                self.inq.put(block)
+                self.n_examples += block_size
         print 'Enqueued all, total of %i' % self.n_examples
         for t in self.threads:
             t.join()
@@ -260,12 +776,33 @@ class InputManager(object):
 
 class InputManagerWinList(object):
     def __init__(self, win_list, filemap,
-                 imdir, tf_out, fn_phds,
-                 lab_phds, enq_op,
+                 imdir, tf_out, fn_phd,
+                 lab_phd, enq_op,
                  batch_size, num_epochs=100,
                  num_threads=4,
                  debug_dir=None,
-                 single_win_mapping=False):
+                 single_win_mapping=False,
+                 pair_sampling='repeat',
+                 loader=None,
+                 dense_batches=False,
+                 seed=None,
+                 resume_from=None,
+                 min_threads=None,
+                 max_threads=None,
+                 scale_interval=30,
+                 file_positions=None,
+                 locality_chunk_size=2**20,
+                 locality_buffer_size=4096,
+                 win_stream=None,
+                 hard_pairs=False,
+                 id_phd=None,
+                 hard_pair_alpha=1.,
+                 hard_pair_beta=1.,
+                 hard_pair_mix=0.1,
+                 trial_list=None,
+                 num_shards=1,
+                 shard_index=0,
+                 hard_pair_refresh=1000):
         """
         Creates an object that manages the input to TensorFlow by managing a
         set of threads that enqueue batches of images. Handles all shuffling
@@ -275,22 +812,95 @@ class InputManagerWinList(object):
             This spawns num_threads + 1 threads, with the last being the
             thread that's running the _Mgr classmethod, which manages enqueuing.
 
-        :param win_list: A list of the form [a, b, wins_a_over_b]
+        :param win_list: A list or N x 3 int array of the form [a, b,
+        wins_a_over_b]. Ignored if win_stream is given.
         :param filemap: A dictionary that maps indices to image filenames.
         :param imdir: The directory that contains the input images.
-        :param tf_out: The FIFO output queue.
-        :param fn_phds: A list of TensorFlow placeholders of len batch_size
-        (type: (tf.string, shape=[]))
-        :param lab_phds: A list of TensorFlow placeholders of len batch_size
-        (type: (tf.int32, shape=[batch_size]))
-        :param enq_op: The TensorFlow enqueue operation.
+        :param tf_out: The FIFO output queue, or a list of them (e.g., one
+        per tower), in which case batches are spread over them round-robin.
+        :param fn_phd: The filename TensorFlow placeholder (type: (tf.string,
+        shape=[batch_size])). If a loader is given, this is instead the image
+        placeholder (type: (tf.uint8, shape=[batch_size, 299, 299, 3]))
+        :param lab_phd: The label TensorFlow placeholder (type: (tf.int32,
+        shape=[batch_size, batch_size]))
+        :param enq_op: The TensorFlow enqueue operation, or a list of them
+        (one per output queue) (see get_array_enqueue_op if a loader is
+        given).
         :param batch_size: The size of a batch.
-        :param num_epochs: The number of epochs to run for.
+        :param num_epochs: The number of epochs to run for. With a win_stream,
+        this may be None to run indefinitely.
         :param num_threads: The number of threads to spawn.
-        :param debug_dir: If not None, it will store the ordering in which it
-        stores the ordering of the inputs per epoch so errors may be re-created.
+        :param debug_dir: If not None, it will store a descriptor of the
+        ordering of the inputs per epoch so errors may be re-created (see
+        replay_epoch_batches and utility/replay_input_order.py).
         :param single_win_mapping: If True, then it will repeatedly enqueue
         items about which we have more data.
+        :param pair_sampling: How pairs are drawn under single_win_mapping.
+        'repeat' enqueues a pair once per win, 'weighted' enqueues each
+        distinct pair once per epoch with its win counts (in both directions)
+        as the labels, and 'proportional' draws pairs with replacement with
+        probability proportional to their win counts, one draw per distinct
+        pair per epoch.
+        :param loader: If not None, decodes and augments the images outside
+        of TensorFlow (e.g., a JpegDecodePool), or fetches them (e.g., a
+        FilePrefetcher, which is told of each batch as it is dispatched).
+        :param dense_batches: If True, batches are composed of images with
+        many comparisons among themselves, and labelled with all of them (see
+        DenseBatchComposer). An epoch is then as many batches as there are
+        distinct pairs / (batch_size / 2), and pair_sampling is ignored.
+        :param seed: The seed from which every epoch's ordering is derived. If
+        None, one is chosen at random.
+        :param resume_from: If not None, a state file written by save_state,
+        from whose position (and seed) the input resumes.
+        :param min_threads: The fewest worker threads to scale down to.
+        Defaults to num_threads.
+        :param max_threads: The most worker threads to scale up to. Defaults
+        to num_threads. If it exceeds min_threads, the number of workers is
+        adjusted (starting from num_threads) to keep the output queues from
+        running dry without filling them.
+        :param scale_interval: How often (in seconds) to consider adding or
+        retiring a worker.
+        :param file_positions: If not None, an array mapping image indices to
+        their (relative) positions on disk (see
+        utility/build_file_positions.py). Each epoch is then reordered so
+        that reads are mostly sequential (see _locality_order).
+        :param locality_chunk_size: The number of pairs that are sorted by
+        disk position together.
+        :param locality_buffer_size: The number of consecutive sorted pairs
+        that are shuffled together.
+        :param win_stream: If not None, a WinLogSampler from which pairs are
+        drawn as the win log grows, rather than in epochs over win_list. An
+        epoch is then nominally as many pairs as there were wins in the log
+        at the start, and its orderings cannot be replayed; pair_sampling,
+        dense_batches and file_positions are ignored.
+        :param hard_pairs: If True, pairs are drawn in proportion to the
+        losses most recently reported for them (see report_losses and
+        HardPairSampler), with importance-weighted labels. Orderings then depend on training,
+        and cannot be replayed; file_positions is ignored.
+        :param id_phd: The pair index row TensorFlow placeholder (type:
+        (tf.int32, shape=[batch_size])) that the enqueue operations were
+        built with, if any. It is required by hard_pairs.
+        :param hard_pair_alpha: The exponent applied to the losses.
+        :param hard_pair_beta: The exponent applied to the importance
+        weights.
+        :param hard_pair_mix: The fraction of draws made without regard to
+        the losses.
+        :param trial_list: If not None, an N x 4 int array of trials of the
+        form [win_1, lose_1, win_2, lose_2], which are packed whole into
+        batches (see TrialBatchComposer) rather than drawing pairs from
+        win_list. pair_sampling, dense_batches and file_positions are then
+        ignored.
+        :param num_shards: The number of input managers (e.g., one per
+        worker in distributed training) that share each epoch. Every one
+        orders the epoch the same way, from the same seed, and dispatches
+        only every num_shards-th batch of it, so their shards are disjoint
+        (except under win_stream or hard_pairs, whose orderings differ
+        between managers). The epoch is then num_shards times shorter.
+        :param shard_index: Which of the num_shards shares of each epoch to
+        dispatch.
+        :param hard_pair_refresh: Under hard_pairs, the number of batches
+        drawn between recomputations of the draw probabilities from the
+        reported losses.
         :return: An instance of InputManager
         """
         self.win_list = win_list
@@ -298,42 +908,151 @@ class InputManagerWinList(object):
         self.imdir = imdir
         self.batch_size = batch_size
         self.num_epochs = num_epochs
-        self.outq = tf_out
-        self.inq = Queue(maxsize=1024)
+        self.outqs = tf_out if isinstance(tf_out, list) else [tf_out]
+        self.outq = self.outqs[0]
+        self.inq = Queue(maxsize=128)
         self.num_threads = num_threads
-        self.fn_phds = fn_phds
-        self.lab_phds = lab_phds
-        self.enq_op = enq_op
+        self.fn_phd = fn_phd
+        self.lab_phd = lab_phd
+        self.enq_ops = enq_op if isinstance(enq_op, list) else [enq_op]
         self.num_threads = num_threads
         self.debug_dir = debug_dir
         self.single_win_mapping = single_win_mapping
+        self.pair_sampling = pair_sampling
+        self.loader = loader
+        self.min_threads = min_threads or num_threads
+        self.max_threads = max_threads or num_threads
+        self.scale_interval = scale_interval
+        # the ops that the scaler monitors the output queues with
+        self.outq_sizes = [q.size() for q in self.outqs]
+        self.outq_capacity = sum(q.queue_ref.op.get_attr('capacity')
+                                 for q in self.outqs)
+        self.batch_times = deque(maxlen=100)
+        self.composer = None
+        self.locality = None
+        if file_positions is not None:
+            self.locality = (np.asarray(file_positions), locality_chunk_size,
+                             locality_buffer_size)
+        self.win_stream = win_stream
+        self.id_phd = id_phd
+        self.hard_pairs = None
+        self.num_shards = num_shards
+        self.shard_index = shard_index
         print 'Allocating indices'
         if not single_win_mapping:
             raise Exception('Currently only implemented for single win mapping')
+        elif win_stream is not None:
+            self.idxs, self.probs = None, None
+        elif trial_list is not None:
+            self.idxs = np.asarray(trial_list, dtype=np.int32).reshape(-1, 4)
+            self.probs = None
+            self.composer = TrialBatchComposer(self.idxs, batch_size)
+        elif dense_batches:
+            self.idxs, self.probs = _build_pair_index(self.win_list,
+                                                      'weighted')
+            self.composer = DenseBatchComposer(self.idxs, batch_size)
         else:
-            self.idxs = []
-            for a, b, w in self.win_list:
-                for _ in range(w):
-                    self.idxs.append([a, b])
-        self.num_ex_per_epoch = len(self.idxs) * 2  # each entails 2 examples
+            self.idxs, self.probs = _build_pair_index(self.win_list,
+                                                      pair_sampling)
+        if win_stream is not None:
+            num_pairs = win_stream.initial_wins
+        elif self.composer is not None:
+            # as many pairs as the composer's batches hold images for
+            num_pairs = self.composer.batches_per_epoch * (batch_size // 2)
+        else:
+            num_pairs = len(self.idxs)
+        if hard_pairs:
+            if id_phd is None or self.idxs is None or self.composer:
+                raise Exception('Hard pair sampling needs an id_phd and a '
+                                'fixed win list without dense batches')
+            self.hard_pairs = HardPairSampler(len(self.idxs), hard_pair_alpha,
+                                              hard_pair_beta, hard_pair_mix)
+            self.hard_pair_refresh = hard_pair_refresh
+        # each entails 2 examples
+        self.num_ex_per_epoch = num_pairs * 2 // num_shards
+        self.batches_per_epoch = num_pairs // (batch_size // 2) // num_shards
+        self.seed = seed
+        if self.seed is None:
+            self.seed = np.random.randint(2**31 - 1)
+        self.start_epoch = 0
+        self.start_offset = 0
+        self.start_step = 0
+        if resume_from is not None:
+            state = _load_input_state(resume_from)
+            self.seed = state['seed']
+            self.start_epoch = state['epoch']
+            self.start_offset = state['offset']
+            self.start_step = state['step'] + 1
+        # the number of batches consumed before the input resumed
+        self.start_batches = (self.start_epoch * self.batches_per_epoch +
+                              self.start_offset)
+        # orderings drawn from a stream or from the losses can't be replayed
+        self.replayable = win_stream is None and not hard_pairs
+        if self.debug_dir is not None and self.replayable:
+            self.order_desc = _order_descriptor(
+                self.idxs, self.seed, batch_size, self.locality,
+                source='win_list', single_win_mapping=single_win_mapping,
+                pair_sampling=pair_sampling, dense_batches=dense_batches,
+                trial_batches=trial_list is not None,
+                batches_per_epoch=self.batches_per_epoch * num_shards,
+                num_shards=num_shards, shard_index=shard_index)
         self.n_examples = 0
         self.should_stop = Event()
-        self.mgr_thread = Thread(target=self._Mgr)
+        self.dispatched = Event()
+        if win_stream is not None:
+            self.mgr_thread = Thread(target=self._StreamMgr)
+            # with no end to the stream, don't hold up the interpreter's exit
+            self.mgr_thread.daemon = num_epochs is None
+        else:
+            self.mgr_thread = Thread(target=self._Mgr)
         self.mgr_thread.start()
         print 'Manager thread started'
 
-    def start(self, sess):
+    def start(self, sess, summary_queue=None, global_step=None):
         """
         Create & Starts all the threads
+
+        :param sess: A TensorFlow session manager.
+        :param summary_queue: If not None, a queue of (summary, step) tuples
+        to which the scaler reports the state of the input (see
+        _summary_worker in aquila_train.py). Otherwise, it prints whenever
+        it adds or retires a worker.
+        :param global_step: The global step variable, which the scaler's
+        summaries are recorded at. Required with a summary_queue.
         """
-        targ = _single_win_map_worker
-        args = (self.filemap, self.imdir, self.batch_size, self.inq, 
-                self.outq, self.fn_phds, self.lab_phds, self.enq_op, sess)
-        self.threads = [Thread(target=targ, args=args)
-                        for _ in range(self.num_threads)]
-        for t in self.threads:
-            t.daemon = True
-            t.start()
+        self.sess = sess
+        self.summary_queue = summary_queue
+        self.global_step = global_step
+        self.enq_cycle = cycle(self.enq_ops)
+        self.threads = []
+        self.stops = []
+        for _ in range(self.num_threads):
+            self._add_worker()
+        if self.max_threads > self.min_threads:
+            self.scaler_thread = Thread(target=self._Scaler)
+            self.scaler_thread.daemon = True
+            self.scaler_thread.start()
+
+    def _add_worker(self):
+        """
+        Starts another worker thread.
+        """
+        stop = Event()
+        args = (self.filemap, self.imdir, self.batch_size, self.inq,
+                self.outq, self.fn_phd, self.lab_phd, self.enq_cycle,
+                self.sess, self.loader, stop, self.batch_times, self.id_phd,
+                self.dispatched)
+        t = Thread(target=_single_win_map_worker, args=args)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+        self.stops.append(stop)
+
+    def _retire_worker(self):
+        """
+        Retires a worker thread once it has enqueued its current batch.
+        """
+        self.stops.pop().set()
 
     def join(self):
         """
@@ -347,22 +1066,185 @@ class InputManagerWinList(object):
         """
         return self.should_stop.is_set()
 
+    def save_state(self, path, step, num_batches):
+        """
+        Saves the position of the input, so that it may be resumed (see
+        resume_from).
+
+        :param path: The file to write.
+        :param step: The last training step that was run.
+        :param num_batches: The total number of batches that have been
+        consumed by training, across all epochs.
+        :return: None
+        """
+        epoch, offset = divmod(num_batches, self.batches_per_epoch)
+        _save_input_state(path, {'seed': self.seed, 'epoch': epoch,
+                                 'offset': offset, 'step': step})
+
+    def report_losses(self, rows, losses):
+        """
+        Reports the losses of the pairs fed in a training step, for hard pair
+        sampling (otherwise this does nothing).
+
+        :param rows: The pair index rows that were dequeued, as enqueued
+        through id_phd.
+        :param losses: Their losses.
+        :return: None
+        """
+        if self.hard_pairs is not None:
+            self.hard_pairs.report(rows, losses)
+
+    def _hard_pair_batches(self, epoch, offset):
+        """
+        Generates the batches of an epoch under hard pair sampling. The epoch
+        is drawn in chunks of hard_pair_refresh batches, each with the
+        probabilities given by the losses reported so far.
+
+        :param epoch: The epoch.
+        :param offset: The number of batches at the start of the epoch to
+        skip.
+        :return: A generator of (indices, labels, ids) tuples.
+        """
+        block_size = self.batch_size // 2
+        num_blocks = len(self.idxs) // block_size
+        chunk = self.hard_pair_refresh
+        for start in xrange(offset - offset % chunk, num_blocks, chunk):
+            probs, weights = self.hard_pairs.epoch_probs(self.probs)
+            rng = np.random.RandomState([self.seed + epoch, start])
+            size = min(chunk, num_blocks - start)
+            rows = rng.choice(len(self.idxs), size=size * block_size,
+                              p=probs).astype(np.int32)
+            for n in xrange(max(offset - start, 0), size):
+                block = rows[n * block_size:(n + 1) * block_size]
+                ids = np.repeat(block, 2)
+                pairs = self.idxs[block]
+                labels = (_pair_labels(pairs, self.batch_size) *
+                          weights[ids][:, None]).astype(np.float32)
+                yield pairs[:, :2].ravel(), labels, ids
+
+    def _dispatch(self, block):
+        """
+        Hands a batch's block to the worker threads, first announcing its
+        images to the loader if it prefetches them (e.g., a FilePrefetcher).
+        """
+        if hasattr(self.loader, 'prefetch'):
+            if isinstance(block, tuple):
+                self.loader.prefetch(block[0])
+            else:
+                self.loader.prefetch(block[:, :2].ravel())
+        self.inq.put(block)
+        self.n_examples += self.batch_size // 2
+
     def _Mgr(self):
         """
         Manager class method. Should be started as a thread.
         """
-        for epoch in range(self.num_epochs):
-            np.random.shuffle(self.idxs)
-            if self.debug_dir is not None:
-                fn = os.path.join(self.debug_dir, 'epoch_%i' % epoch)
-                np.save(fn, self.idxs)
-            for idxs_pair in self.idxs:
-                self.inq.put(idxs_pair)
-                self.n_examples += 1
+        for epoch in range(self.start_epoch, self.num_epochs):
+            offset = 0
+            if epoch == self.start_epoch:
+                offset = self.start_offset
+            if self.debug_dir is not None and self.replayable:
+                _write_order_descriptor(self.debug_dir, epoch, self.order_desc)
+            if self.hard_pairs is not None:
+                blocks = self._hard_pair_batches(epoch,
+                                                 offset * self.num_shards)
+            else:
+                blocks = _epoch_batches(self.idxs, self.probs, self.seed,
+                                        epoch, self.batch_size,
+                                        self.composer,
+                                        offset * self.num_shards,
+                                        self.locality)
+            blocks = _shard_blocks(blocks, offset, self.num_shards,
+                                   self.shard_index,
+                                   self.batches_per_epoch * self.num_shards)
+            for block in blocks:
+                self._dispatch(block)
         print 'Enqueued all, total of %i' % self.n_examples
+        self.dispatched.set()
         for t in self.threads:
             t.join()
+        if self.loader is not None:
+            self.loader.close()
         self.should_stop.set()
 
+    def _stream_rng(self, epoch):
+        """
+        Returns the random number generator that a win_stream epoch is drawn
+        with. Each shard draws its own pairs, rather than a share of the same
+        draws.
+        """
+        if self.num_shards == 1:
+            return np.random.RandomState(self.seed + epoch)
+        return np.random.RandomState([self.seed + epoch, self.shard_index])
+
+    def _StreamMgr(self):
+        """
+        Manager class method for a win_stream. Should be started as a thread.
+        """
+        epoch = self.start_epoch
+        num_blocks = self.start_offset
+        rng = self._stream_rng(epoch)
+        while self.num_epochs is None or epoch < self.num_epochs:
+            self._dispatch(self.win_stream.next_block(rng))
+            num_blocks += 1
+            if num_blocks == self.batches_per_epoch:
+                epoch += 1
+                num_blocks = 0
+                rng = self._stream_rng(epoch)
+        print 'Enqueued all, total of %i' % self.n_examples
+        self.dispatched.set()
+        for t in self.threads:
+            t.join()
+        if self.loader is not None:
+            self.loader.close()
+        self.should_stop.set()
 
+    def _Scaler(self):
+        """
+        Scaler class method. Should be started as a thread. Adds a worker
+        when the output queues are running low because the workers are busy
+        preparing batches, and retires one when they are nearly full.
 
+        NOTES:
+            The workers' utilization is the fraction of the last interval
+            they spent preparing batches, estimated as the number of batches
+            they took up times their mean preparation time. If the queues run
+            low while the workers are mostly idle, they are waiting on the
+            manager thread (or the loader), and more workers wouldn't help.
+        """
+        num_taken = (self.n_examples // (self.batch_size // 2) -
+                     self.inq.qsize())
+        while not self.should_stop.wait(self.scale_interval):
+            occupancy = (sum(self.sess.run(self.outq_sizes)) /
+                         float(self.outq_capacity))
+            num_threads = len(self.stops)
+            batch_time = np.mean(self.batch_times) if self.batch_times else 0.
+            # the number of batches the workers have taken from the manager
+            last_taken = num_taken
+            num_taken = (self.n_examples // (self.batch_size // 2) -
+                         self.inq.qsize())
+            utilization = ((num_taken - last_taken) * batch_time /
+                           (num_threads * self.scale_interval))
+            changed = True
+            if (occupancy < 0.25 and utilization > 0.75 and
+                    num_threads < self.max_threads):
+                self._add_worker()
+            elif occupancy > 0.9 and num_threads > self.min_threads:
+                self._retire_worker()
+            else:
+                changed = False
+            if self.summary_queue is not None:
+                values = [('input/worker_threads', len(self.stops)),
+                          ('input/queue_occupancy', occupancy),
+                          ('input/sec_per_batch', batch_time),
+                          ('input/worker_utilization', utilization)]
+                summary = tf.Summary(value=[
+                    tf.Summary.Value(tag=tag, simple_value=value)
+                    for tag, value in values])
+                self.summary_queue.put((summary,
+                                        self.sess.run(self.global_step)))
+            elif changed:
+                print ('Input queues %.0f%% full (%.3f sec/batch, %.0f%% '
+                       'utilization), now running %i worker threads' %
+                       (100 * occupancy, batch_time, 100 * utilization,
+                        len(self.stops)))
@@ -0,0 +1,91 @@
+"""
+A packed store of the encoded training images, as written by
+utility/build_jpeg_store.py. The JPEG bytes of every image are concatenated
+into a few large shard files, so that feeding a batch slices the encoded
+images out of memory rather than opening, stat-ing and reading a file per
+image. The images are still decoded and augmented in the TensorFlow graph
+(see training.input.get_encoded_enqueue_op).
+
+The store is a directory holding shards named shard_00000.bin,
+shard_00001.bin, ... and index.npy, an int64 array of shape [num_images, 3]
+whose row i is (shard, offset, length) of the image with index i (in the
+idx_2_id file). Images without data have a length of 0.
+"""
+
+import os
+import mmap
+from glob import glob
+import numpy as np
+
+INDEX_NAME = 'index.npy'
+SHARD_PATTERN = 'shard_%05i.bin'
+
+
+class PackedJpegStore(object):
+    def __init__(self, store_dir, batch_size, in_memory=False):
+        """
+        Opens a packed JPEG store for use as an input manager loader.
+
+        :param store_dir: The directory that contains the store.
+        :param batch_size: The size of a batch.
+        :param in_memory: Whether to read the shards into memory up front
+        rather than memory-map them.
+        :return: An instance of PackedJpegStore
+        """
+        self.store_dir = store_dir
+        self.batch_size = batch_size
+        index_fn = os.path.join(store_dir, INDEX_NAME)
+        if not os.path.exists(index_fn):
+            raise Exception('No JPEG store found in %s' % store_dir)
+        self.index = np.load(index_fn)
+        num_shards = len(glob(os.path.join(store_dir, 'shard_*.bin')))
+        if num_shards <= self.index[:, 0].max():
+            raise Exception('The JPEG store in %s is missing shards' %
+                            store_dir)
+        self.shards = []
+        for shard in range(num_shards):
+            with open(os.path.join(store_dir, SHARD_PATTERN % shard),
+                      'rb') as f:
+                if in_memory:
+                    self.shards.append(f.read())
+                else:
+                    self.shards.append(mmap.mmap(f.fileno(), 0,
+                                                 access=mmap.ACCESS_READ))
+        self.num_images = len(self.index)
+
+    def get(self, idx):
+        """
+        Returns the encoded bytes of a stored image.
+
+        :param idx: The index of the image.
+        :return: A string.
+        """
+        shard, offset, length = self.index[idx]
+        if not length:
+            raise Exception('Image %i is not in the JPEG store' % idx)
+        return self.shards[shard][offset:offset + length]
+
+    def load(self, indices):
+        """
+        Fetches the encoded images for a batch.
+
+        :param indices: The indices of the images in the batch.
+        :return: A tuple (handle, images), where images is a list of
+        batch_size encoded JPEGs. The handle is unused.
+        """
+        return None, [self.get(x) for x in indices]
+
+    def release(self, handle):
+        """
+        Does nothing; the batches returned by load are not reused.
+        """
+        pass
+
+    def close(self):
+        """
+        Unmaps the shards.
+        """
+        for shard in self.shards:
+            if isinstance(shard, mmap.mmap):
+                shard.close()
+        self.shards = []
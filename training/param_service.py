@@ -0,0 +1,263 @@
+"""
+A parameter service for data-parallel training across processes (and
+machines), each of which trains a replica of the model on its own shard of
+the input.
+
+Every worker pushes the gradients of each step to the service, along with
+any other state it updates locally (e.g., batch norm moving statistics),
+which averages them over the workers. Every worker then applies the same
+averages, in the same order, so the replicas stay identical. With a
+max_staleness of 0 the workers are synchronous: a step's average is applied
+before the next step is computed. With a max_staleness of s, a worker
+applies the average of step t - s after computing step t, so workers may
+run up to s steps ahead of the slowest, at the cost of computing gradients
+on parameters that are up to s updates old (and of averaged state that
+replaces the worker's own last s updates to it).
+
+The service runs in a thread of the chief worker (task 0), which also
+broadcasts its initial variable values. Messages are pickled over
+multiprocessing connections, so any host that can reach the chief's address
+may join.
+
+If a worker fails (its connection drops before it says it is done, or it
+aborts), every worker waiting on the service is told, and raises, rather
+than waiting forever for gradients that will never arrive.
+"""
+
+import time
+from multiprocessing.connection import Client
+from multiprocessing.connection import Listener
+from threading import Condition
+from threading import Thread
+
+
+class ParamService(object):
+    def __init__(self, address, authkey, num_workers):
+        """
+        Starts a parameter service that listens for workers.
+
+        :param address: The (host, port) to listen on.
+        :param authkey: The key that workers must present.
+        :param num_workers: The number of workers whose gradients are
+        averaged at each step.
+        :return: An instance of ParamService
+        """
+        self.num_workers = num_workers
+        self.listener = Listener(address, authkey=authkey)
+        self.cond = Condition()
+        self.init_values = None
+        # step -> [summed gradients, number of workers that have pushed]
+        self.sums = dict()
+        # step -> [averaged gradients, number of workers yet to pull]
+        self.averages = dict()
+        self.num_done = 0
+        # why training was aborted, if it was
+        self.aborted = None
+        self.thread = Thread(target=self._Acceptor)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def join(self):
+        """
+        Waits until every worker is done (or training was aborted), so that
+        the service outlives the workers still pulling their last averages.
+        """
+        with self.cond:
+            while self.num_done < self.num_workers and self.aborted is None:
+                self.cond.wait()
+
+    def _Acceptor(self):
+        """
+        Acceptor class method. Should be started as a thread.
+        """
+        while True:
+            conn = self.listener.accept()
+            t = Thread(target=self._Server, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _Server(self, conn):
+        """
+        Server class method, which serves one worker's connection. Should be
+        started as a thread.
+        """
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, IOError):
+                self._abort('a worker disconnected')
+                return
+            if msg[0] == 'push':
+                self._push(msg[1], msg[2])
+            elif msg[0] == 'pull':
+                conn.send(self._pull(msg[1]))
+            elif msg[0] == 'broadcast':
+                with self.cond:
+                    self.init_values = msg[1]
+                    self.cond.notify_all()
+            elif msg[0] == 'receive':
+                with self.cond:
+                    while self.init_values is None and self.aborted is None:
+                        self.cond.wait()
+                    if self.aborted is not None:
+                        conn.send(('abort', self.aborted))
+                    else:
+                        conn.send(('ok', self.init_values))
+            elif msg[0] == 'abort':
+                self._abort(msg[1])
+                return
+            elif msg[0] == 'done':
+                with self.cond:
+                    self.num_done += 1
+                    self.cond.notify_all()
+                return
+            else:
+                raise Exception('Unknown message %s' % msg[0])
+
+    def _abort(self, reason):
+        """
+        Marks training as aborted, waking every worker that is waiting.
+        """
+        with self.cond:
+            if self.aborted is None:
+                self.aborted = reason
+            self.cond.notify_all()
+
+    def _push(self, step, grads):
+        """
+        Adds a worker's gradients for a step, averaging them once every
+        worker's have arrived.
+        """
+        with self.cond:
+            if step not in self.sums:
+                self.sums[step] = [grads, 1]
+            else:
+                entry = self.sums[step]
+                entry[0] = [t + g for t, g in zip(entry[0], grads)]
+                entry[1] += 1
+            if self.sums[step][1] == self.num_workers:
+                total = self.sums.pop(step)[0]
+                self.averages[step] = [
+                    [t / float(self.num_workers) for t in total],
+                    self.num_workers]
+                self.cond.notify_all()
+
+    def _pull(self, step):
+        """
+        Returns the averaged gradients of a step, waiting for them if need
+        be, as an ('ok', gradients) tuple, or an ('abort', reason) tuple if
+        training was aborted first. They are dropped once every worker has
+        pulled them.
+        """
+        with self.cond:
+            while step not in self.averages and self.aborted is None:
+                self.cond.wait()
+            if step not in self.averages:
+                return 'abort', self.aborted
+            entry = self.averages[step]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.averages[step]
+            return 'ok', entry[0]
+
+
+class ParamClient(object):
+    def __init__(self, address, authkey, max_staleness=0, timeout=300):
+        """
+        Connects a worker to a parameter service, retrying until it is up.
+
+        :param address: The (host, port) of the service.
+        :param authkey: The service's key.
+        :param max_staleness: The number of steps that the gradients applied
+        by step may lag behind those pushed.
+        :param timeout: How long (in seconds) to keep trying to connect.
+        :return: An instance of ParamClient
+        """
+        self.max_staleness = max_staleness
+        start = time.time()
+        while True:
+            try:
+                self.conn = Client(address, authkey=authkey)
+                break
+            except EnvironmentError:
+                if time.time() - start > timeout:
+                    raise
+                time.sleep(1)
+        self.first_step = None
+
+    def _recv(self):
+        """
+        Receives a reply from the service, raising if training was aborted.
+        """
+        status, value = self.conn.recv()
+        if status == 'abort':
+            raise Exception('Training was aborted: %s' % value)
+        return value
+
+    def broadcast(self, values):
+        """
+        Makes the chief's initial variable values available to the workers.
+
+        :param values: A list of numpy arrays.
+        :return: None
+        """
+        self.conn.send(('broadcast', values))
+
+    def receive(self):
+        """
+        Fetches the chief's initial variable values, waiting for them if
+        need be.
+
+        :return: A list of numpy arrays.
+        """
+        self.conn.send(('receive',))
+        return self._recv()
+
+    def step(self, step, grads):
+        """
+        Pushes the gradients of a step, and returns the averaged gradients
+        to apply next, i.e., those of step - max_staleness.
+
+        :param step: The step.
+        :param grads: A list of numpy arrays.
+        :return: A list of numpy arrays, or None if there are no averaged
+        gradients to apply yet.
+        """
+        if self.first_step is None:
+            self.first_step = step
+        self.conn.send(('push', step, grads))
+        if step - self.max_staleness < self.first_step:
+            return None
+        self.conn.send(('pull', step - self.max_staleness))
+        return self._recv()
+
+    def drain(self, last_step):
+        """
+        Returns the averaged gradients that have yet to be applied once the
+        last step has been pushed, one step at a time.
+
+        :param last_step: The last step that was pushed.
+        :return: A generator of lists of numpy arrays.
+        """
+        first = max(last_step - self.max_staleness + 1, self.first_step)
+        for step in xrange(first, last_step + 1):
+            self.conn.send(('pull', step))
+            yield self._recv()
+
+    def abort(self, reason):
+        """
+        Aborts training, so that the other workers raise rather than wait
+        for this one.
+
+        :param reason: Why, as a string.
+        :return: None
+        """
+        self.conn.send(('abort', reason))
+        self.conn.close()
+
+    def close(self):
+        """
+        Tells the service that this worker is done.
+        """
+        self.conn.send(('done',))
+        self.conn.close()
@@ -0,0 +1,102 @@
+"""
+Prefetches the image files of upcoming batches with many concurrent reads,
+for image storage (e.g., a network volume) on which each read has a high
+latency but many reads may be in flight at once. The encoded images are
+handed to the enqueue operation, which decodes them in the TensorFlow graph
+(see training.input.get_encoded_enqueue_op).
+
+NOTES:
+    The reads are blocking file reads issued from a pool of threads, which
+    release the GIL while they wait on the storage.
+"""
+
+import os
+from threading import Lock
+from threading import Semaphore
+from multiprocessing.pool import ThreadPool
+
+
+def _read(fn):
+    """
+    The pool task. Reads a whole file.
+    """
+    with open(fn, 'rb') as f:
+        return f.read()
+
+
+class FilePrefetcher(object):
+    def __init__(self, filemap, imdir, batch_size, num_reads=256,
+                 num_batches=16):
+        """
+        Creates an input manager loader that reads the files of upcoming
+        batches ahead of time. The input manager announces each batch with
+        prefetch(indices) as it is dispatched, and load(indices) then
+        returns its files' contents, waiting for any reads still in flight.
+
+        :param filemap: A dictionary that maps indices to image filenames.
+        :param imdir: The directory that contains the input images.
+        :param batch_size: The size of a batch.
+        :param num_reads: The number of reads that may be in flight at once.
+        :param num_batches: The number of batches that may be prefetched
+        ahead of the feeder threads, which bounds the memory used.
+        :return: An instance of FilePrefetcher
+        """
+        self.filemap = filemap
+        self.imdir = imdir
+        self.batch_size = batch_size
+        self.pool = ThreadPool(num_reads)
+        self.slots = Semaphore(num_batches)
+        self.lock = Lock()
+        # index -> [AsyncResult, number of prefetched batches that need it]
+        self.pending = dict()
+
+    def prefetch(self, indices):
+        """
+        Starts reading the files of a batch, blocking while num_batches
+        batches are already prefetched. Files that are already being read
+        for another batch are read only once.
+
+        :param indices: The indices of the images in the batch.
+        :return: None
+        """
+        self.slots.acquire()
+        with self.lock:
+            for x in set(indices):
+                entry = self.pending.get(x)
+                if entry is None:
+                    fn = os.path.join(self.imdir, self.filemap[x])
+                    entry = [self.pool.apply_async(_read, (fn,)), 0]
+                    self.pending[x] = entry
+                entry[1] += 1
+
+    def load(self, indices):
+        """
+        Fetches the encoded images for a batch that has been prefetched.
+
+        :param indices: The indices of the images in the batch.
+        :return: A tuple (handle, images), where images is a list of
+        batch_size encoded JPEGs. The handle is unused.
+        """
+        with self.lock:
+            results = dict((x, self.pending[x][0]) for x in set(indices))
+            for x in results:
+                entry = self.pending[x]
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.pending[x]
+        self.slots.release()
+        data = dict((x, r.get()) for x, r in results.iteritems())
+        return None, [data[x] for x in indices]
+
+    def release(self, handle):
+        """
+        Does nothing; the batches returned by load are not reused.
+        """
+        pass
+
+    def close(self):
+        """
+        Terminates the reading threads.
+        """
+        self.pool.terminate()
+        self.pool.join()
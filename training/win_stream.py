@@ -0,0 +1,162 @@
+"""
+Samples pairs from an append-only win log, so that training can run
+continuously while new comparisons arrive. The log has the format of the
+win list ("a,b,wins_a_over_b" lines); new lines are folded into the
+per-pair win counts as they land, without re-shuffling or re-reading the
+log.
+
+Pairs are drawn with replacement, in proportion to their total win counts
+(as with pair_sampling == 'proportional'), times a recency boost that
+decays with the number of comparisons that have arrived since the pair was
+last seen. Blocks have the rows of the 'weighted' pair index, i.e.
+[a, b, wins_a_over_b, wins_b_over_a].
+"""
+
+import time
+import numpy as np
+from training.input import _aggregate_win_list
+
+
+class WinLogSampler(object):
+    def __init__(self, log_path, batch_size, valid_images=None,
+                 half_life=10**6, recency_boost=4., poll_interval=60):
+        """
+        Opens a win log and folds in the comparisons it already holds.
+
+        :param log_path: The win log, which may be appended to while it is
+        being sampled.
+        :param batch_size: The size of a batch.
+        :param valid_images: If not None, a collection of the image indices
+        that may be fed (e.g., the filemap). Comparisons involving other
+        images are skipped.
+        :param half_life: The number of newly arrived comparisons after which
+        a pair's recency boost is halved.
+        :param recency_boost: How much more likely a pair that was just seen
+        is to be drawn than one that was last seen long ago. 0 disables
+        recency weighting.
+        :param poll_interval: How often (in seconds) to check the log for
+        new comparisons.
+        :return: An instance of WinLogSampler
+        """
+        self.log_path = log_path
+        self.block_size = batch_size // 2
+        self.valid_images = None
+        if valid_images is not None:
+            self.valid_images = np.array(sorted(valid_images), dtype=np.int64)
+        self.half_life = float(half_life)
+        self.recency_boost = recency_boost
+        self.poll_interval = poll_interval
+        self.pair_ids = dict()
+        self.pairs = np.zeros((1024, 4), dtype=np.int32)
+        # the value of num_wins when each pair last received a comparison
+        self.last_seen = np.zeros(1024, dtype=np.int64)
+        self.num_pairs = 0
+        self.num_wins = 0
+        self.num_skipped = 0
+        self.num_malformed = 0
+        self.offset = 0  # the number of bytes of the log folded in
+        self.last_poll = 0
+        self.poll()
+        if not self.num_pairs:
+            raise Exception('The win log %s holds no usable comparisons' %
+                            log_path)
+        self.initial_wins = self.num_wins
+
+    def poll(self):
+        """
+        Folds in the comparisons that have been appended to the log since the
+        last poll. A trailing partial line is left for the next poll. Blank
+        lines are ignored, and malformed lines are reported and skipped.
+
+        :return: The number of new wins.
+        """
+        self.last_poll = time.time()
+        with open(self.log_path, 'r') as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind('\n') + 1
+        self.offset += end
+        win_list = self._parse(data[:end])
+        if self.valid_images is not None and len(win_list):
+            valid = (np.in1d(win_list[:, 0], self.valid_images) &
+                     np.in1d(win_list[:, 1], self.valid_images))
+            self.num_skipped += np.sum(~valid)
+            win_list = win_list[valid]
+        win_list = win_list[win_list[:, 2] > 0]
+        if not len(win_list):
+            return 0
+        self.num_wins += win_list[:, 2].sum()
+        for a, b, w_ab, w_ba in _aggregate_win_list(win_list):
+            self._fold(a, b, w_ab, w_ba)
+        self._reweight()
+        return win_list[:, 2].sum()
+
+    def _parse(self, data):
+        """
+        Parses complete lines of the log into an N x 3 int64 array.
+        """
+        lines = [x for x in data.split('\n') if x.strip()]
+        values = np.fromstring(','.join(lines), dtype=np.int64, sep=',')
+        if len(values) == 3 * len(lines):
+            return values.reshape(-1, 3)
+        # fromstring stops at the first malformed value, so find the
+        # malformed lines one at a time
+        rows = []
+        for line in lines:
+            try:
+                row = [int(x) for x in line.split(',')]
+            except ValueError:
+                row = None
+            if row is None or len(row) != 3:
+                print 'Win log: skipping malformed line %r' % line
+                self.num_malformed += 1
+                continue
+            rows.append(row)
+        return np.array(rows, dtype=np.int64).reshape(-1, 3)
+
+    def _fold(self, a, b, w_ab, w_ba):
+        """
+        Adds wins to a pair (with a < b), allocating it if it is new.
+        """
+        pid = self.pair_ids.get((a, b))
+        if pid is None:
+            pid = self.num_pairs
+            if pid == len(self.pairs):
+                self.pairs = np.concatenate((self.pairs,
+                                             np.zeros_like(self.pairs)))
+                self.last_seen = np.concatenate(
+                    (self.last_seen, np.zeros_like(self.last_seen)))
+            self.pairs[pid, :2] = (a, b)
+            self.pair_ids[(a, b)] = pid
+            self.num_pairs += 1
+        self.pairs[pid, 2] += w_ab
+        self.pairs[pid, 3] += w_ba
+        self.last_seen[pid] = self.num_wins
+
+    def _reweight(self):
+        """
+        Recomputes the cumulative sampling weights of the pairs.
+        """
+        pairs = self.pairs[:self.num_pairs]
+        age = self.num_wins - self.last_seen[:self.num_pairs]
+        weights = (pairs[:, 2] + pairs[:, 3]) * (
+            1. + self.recency_boost * np.exp2(-age / self.half_life))
+        self.cum_weights = np.cumsum(weights)
+
+    def next_block(self, rng=np.random):
+        """
+        Draws the pairs for a batch, first folding in any new comparisons if
+        the log is due to be polled.
+
+        :param rng: The random number generator (e.g., a RandomState) to use.
+        :return: An int32 array of shape [batch_size / 2, 4]
+        """
+        if time.time() - self.last_poll >= self.poll_interval:
+            if self.poll():
+                print ('Win log: %i pairs, %i wins (%i comparisons skipped, '
+                       '%i malformed lines)' % (self.num_pairs, self.num_wins,
+                                                self.num_skipped,
+                                                self.num_malformed))
+        draws = rng.rand(self.block_size) * self.cum_weights[-1]
+        rows = np.searchsorted(self.cum_weights, draws, side='right')
+        return self.pairs[np.minimum(rows, self.num_pairs - 1)]
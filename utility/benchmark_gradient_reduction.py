@@ -0,0 +1,50 @@
+"""
+Times the ways of averaging the towers' gradients (see
+aquila_train._average_gradients) on synthetic gradients shaped like those of
+the model's largest and most numerous variables. The gradients are computed
+on each gpu and reduced onto the variables on /cpu:0, as in training.
+
+Usage (from the repository root):
+    PYTHONPATH=. python utility/benchmark_gradient_reduction.py
+"""
+
+import time
+
+import tensorflow as tf
+
+import config
+from aquila_train import _average_gradients
+
+NUM_TRIALS = 20
+# (shape, count): the logits' and the mixed layers' larger weights, and the
+# many small batch norm parameters
+VAR_SHAPES = [([2048, config.abs_feats], 1), ([3, 3, 384, 384], 8),
+              ([1, 1, 2048, 448], 6), ([384], 200)]
+METHODS = [('concat', None), ('add_n', None), ('tree', None),
+           ('add_n', 2**20), ('tree', 2**20)]
+
+variables = []
+with tf.device('/cpu:0'):
+    for shape, count in VAR_SHAPES:
+        for _ in range(count):
+            variables.append(tf.Variable(tf.zeros(shape)))
+tower_grads = []
+for i in range(config.num_gpus):
+    with tf.device('/gpu:%d' % i):
+        # a gradient that must be recomputed on every run, like a real one
+        tower_grads.append([(tf.random_normal(v.get_shape()), v)
+                            for v in variables])
+ops = []
+for method, chunk_size in METHODS:
+    grads = _average_gradients(tower_grads, method, chunk_size)
+    ops.append(tf.group(*[g for g, _ in grads]))
+
+sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+sess.run(tf.initialize_all_variables())
+for (method, chunk_size), op in zip(METHODS, ops):
+    sess.run(op)  # warm up
+    start = time.time()
+    for _ in range(NUM_TRIALS):
+        sess.run(op)
+    print '%s (chunk size %s): %.1f ms per reduction' % (
+        method, chunk_size, 1000 * (time.time() - start) / NUM_TRIALS)
@@ -0,0 +1,54 @@
+"""
+Writes the preprocessed training images (see preproc_resize_pad.py) into a
+sharded, memory-mapped uint8 store so that they need not be decoded during
+training (see training/image_store.py). Image i of the store is the image
+with index i in the idx_2_id file.
+
+Completed shards are skipped, so this may be re-run if interrupted.
+"""
+
+from PIL import Image
+import numpy as np
+import os
+
+FILE_MAP_LOC = '/data/datasets/idx_2_id'
+IMG_DIR = '/data/images'
+STORE_DIR = '/data/image_store'
+SHARD_SIZE = 10000  # ~2.9 GB per shard
+IM_SIZE = 314
+SHARD_PATTERN = 'shard_%05i.npy'
+
+fnmap = dict()
+print 'Loading index to filename map'
+with open(FILE_MAP_LOC, 'r') as f:
+    for line in f:
+        idx, fn = line.strip().split(',')
+        fnmap[int(idx)] = fn + '.jpg'
+
+if not os.path.exists(STORE_DIR):
+    os.makedirs(STORE_DIR)
+
+num_images = max(fnmap.keys()) + 1
+num_shards = (num_images + SHARD_SIZE - 1) // SHARD_SIZE
+for shard in range(num_shards):
+    fn = os.path.join(STORE_DIR, SHARD_PATTERN % shard)
+    if os.path.exists(fn):
+        continue
+    start = shard * SHARD_SIZE
+    stop = min(start + SHARD_SIZE, num_images)
+    # write to a temporary file so that partially written shards are redone
+    tmp_fn = fn + '.tmp'
+    arr = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=np.uint8,
+                                    shape=(stop - start, IM_SIZE, IM_SIZE, 3))
+    for idx in range(start, stop):
+        if idx not in fnmap:
+            print 'Index %i has no image, leaving it blank' % idx
+            continue
+        imd = Image.open(os.path.join(IMG_DIR, fnmap[idx])).convert('RGB')
+        if imd.size != (IM_SIZE, IM_SIZE):
+            imd = imd.resize((IM_SIZE, IM_SIZE), Image.ANTIALIAS)
+        arr[idx - start] = np.asarray(imd)
+    arr.flush()
+    del arr
+    os.rename(tmp_fn, fn)
+    print '%i/%i - %s' % (shard + 1, num_shards, fn)
@@ -0,0 +1,58 @@
+"""
+Packs the preprocessed training images (see preproc_resize_pad.py) into a
+few large shard files with an offset index, so that they may be fed without
+any per-image filesystem access (see training/jpeg_store.py). The JPEG bytes
+are copied as is; nothing is decoded or re-encoded.
+
+The index is written last, so an interrupted run leaves no usable store and
+should simply be re-run.
+"""
+
+import numpy as np
+import os
+
+FILE_MAP_LOC = '/data/datasets/idx_2_id'
+IMG_DIR = '/data/images'
+STORE_DIR = '/data/jpeg_store'
+SHARD_BYTES = 2**30  # start a new shard once a shard reaches 1 GB
+INDEX_NAME = 'index.npy'
+SHARD_PATTERN = 'shard_%05i.bin'
+
+fnmap = dict()
+print 'Loading index to filename map'
+with open(FILE_MAP_LOC, 'r') as f:
+    for line in f:
+        idx, fn = line.strip().split(',')
+        fnmap[int(idx)] = fn + '.jpg'
+
+if not os.path.exists(STORE_DIR):
+    os.makedirs(STORE_DIR)
+
+num_images = max(fnmap.keys()) + 1
+# rows of (shard, offset, length)
+index = np.zeros((num_images, 3), dtype=np.int64)
+shard = 0
+out = open(os.path.join(STORE_DIR, SHARD_PATTERN % shard), 'wb')
+offset = 0
+for idx in range(num_images):
+    if idx not in fnmap:
+        print 'Index %i has no image, leaving it empty' % idx
+        continue
+    with open(os.path.join(IMG_DIR, fnmap[idx]), 'rb') as f:
+        data = f.read()
+    if offset and offset + len(data) > SHARD_BYTES:
+        out.close()
+        print 'Wrote %s' % out.name
+        shard += 1
+        out = open(os.path.join(STORE_DIR, SHARD_PATTERN % shard), 'wb')
+        offset = 0
+    out.write(data)
+    index[idx] = (shard, offset, len(data))
+    offset += len(data)
+out.close()
+print 'Wrote %s' % out.name
+# write to a temporary file so that a partial index is never read
+index_fn = os.path.join(STORE_DIR, INDEX_NAME)
+np.save(index_fn + '.tmp', index)
+os.rename(index_fn + '.tmp.npy', index_fn)
+print 'Packed %i images into %i shards' % (len(fnmap), shard + 1)
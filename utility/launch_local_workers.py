@@ -0,0 +1,57 @@
+"""
+Starts all config.num_workers training workers (see init_train.py) on this
+machine, e.g. to try distributed training out over localhost. Each worker's
+output is written to worker_N.log in LOG_DIR. If any worker fails, the
+others are stopped, even if they are not waiting on the parameter service.
+
+Usage (from the repository root):
+    PYTHONPATH=. python utility/launch_local_workers.py LOG_DIR --cpu_only
+
+With --cpu_only the workers don't see the GPUs, and their towers are placed
+on the CPU; otherwise every worker would build its towers on the same GPUs.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import config
+
+parser = argparse.ArgumentParser(description='Starts local training workers')
+parser.add_argument('log_dir', help='where to write the workers\' output')
+parser.add_argument('--cpu_only', action='store_true',
+                    help='hide the GPUs from the workers')
+args = parser.parse_args()
+
+if not os.path.exists(args.log_dir):
+    os.makedirs(args.log_dir)
+env = dict(os.environ)
+if args.cpu_only:
+    env['CUDA_VISIBLE_DEVICES'] = ''
+
+procs = []
+for task_index in range(config.num_workers):
+    log = open(os.path.join(args.log_dir, 'worker_%i.log' % task_index), 'w')
+    procs.append(subprocess.Popen(
+        [sys.executable, 'init_train.py', str(task_index)], env=env,
+        stdout=log, stderr=subprocess.STDOUT))
+    print 'Started worker %i (pid %i)' % (task_index, procs[-1].pid)
+
+failed = False
+while any(p.poll() is None for p in procs):
+    for task_index, p in enumerate(procs):
+        if p.returncode:
+            print 'Worker %i failed with code %i' % (task_index, p.returncode)
+            failed = True
+    if failed:
+        for p in procs:
+            if p.poll() is None:
+                p.terminate()
+        break
+    time.sleep(5)
+for task_index, p in enumerate(procs):
+    p.wait()
+    print 'Worker %i exited with code %i' % (task_index, p.returncode)
+sys.exit(1 if any(p.returncode for p in procs) else 0)
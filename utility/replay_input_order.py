@@ -0,0 +1,88 @@
+"""
+Regenerates the ordering of the input from the epoch descriptors that the
+input managers write to their debug_dir, so that a problem batch may be
+re-created without the orderings ever having been saved.
+
+Usage (from the repository root):
+    PYTHONPATH=. python utility/replay_input_order.py DESCRIPTOR WIN_DATA \
+        --step 12345 --num_gpus 4 --accumulation_steps 1
+    PYTHONPATH=. python utility/replay_input_order.py DESCRIPTOR WIN_DATA \
+        --out epoch_3.npy
+
+where DESCRIPTOR is e.g. /data/training_epoch_sequence/epoch_3.json and
+WIN_DATA is the win list (or win matrix, or trial list) that training used. If training
+ordered its reads for locality, pass the file positions it used with
+--file_positions. If training was distributed, each worker's input manager
+wrote its own descriptors, and regenerates that worker's shard of the epoch.
+
+The second form writes the pair rows of the whole epoch in the order they
+were dispatched (for dense batches, the image indices of each batch).
+"""
+
+import argparse
+import json
+
+import numpy as np
+from scipy import io
+from scipy import sparse
+
+from training.input import replay_epoch_batches
+
+parser = argparse.ArgumentParser(description='Regenerates input orderings')
+parser.add_argument('descriptor', help='an epoch_N.json descriptor')
+parser.add_argument('win_data', help='the win list (or a .mtx win matrix, '
+                                     'or the trial list)')
+parser.add_argument('--batch', type=int, default=None,
+                    help='the (global) batch number to regenerate')
+parser.add_argument('--step', type=int, default=None,
+                    help='the training step whose batches to regenerate')
+parser.add_argument('--num_gpus', type=int, default=1,
+                    help='the number of towers training ran with')
+parser.add_argument('--accumulation_steps', type=int, default=1,
+                    help='the number of micro-batches per training step')
+parser.add_argument('--out', default=None,
+                    help='where to write the ordering of the whole epoch')
+parser.add_argument('--file_positions', default=None,
+                    help='the file positions used in training, if any')
+args = parser.parse_args()
+
+with open(args.descriptor, 'r') as f:
+    desc = json.load(f)
+if desc['source'] == 'win_matrix':
+    win_data = sparse.lil_matrix(io.mmread(args.win_data).astype(np.uint8))
+else:
+    win_data = np.loadtxt(args.win_data, delimiter=',', dtype=np.int32,
+                          ndmin=2)
+file_positions = None
+if args.file_positions is not None:
+    file_positions = np.load(args.file_positions)
+
+if args.step is not None or args.batch is not None:
+    if args.step is not None:
+        # each tower consumes a batch per micro-batch
+        per_step = args.num_gpus * args.accumulation_steps
+        batches = range(args.step * per_step, (args.step + 1) * per_step)
+    else:
+        batches = [args.batch]
+    for batch in batches:
+        # with several shards, batches (and steps) are counted per shard
+        epoch, offset = divmod(batch, desc['batches_per_epoch'] //
+                               desc.get('num_shards', 1))
+        block = next(replay_epoch_batches(desc, win_data, epoch, offset,
+                                          file_positions))
+        print 'Batch %i (epoch %i, batch %i of the epoch):' % (batch, epoch,
+                                                               offset)
+        if isinstance(block, tuple):
+            indices, labels = block
+            print 'indices:', indices
+            print 'labels:'
+            print labels
+        else:
+            print block
+else:
+    blocks = replay_epoch_batches(desc, win_data, desc['epoch'],
+                                  file_positions=file_positions)
+    rows = np.array([x[0] if isinstance(x, tuple) else x for x in blocks])
+    out = args.out or 'epoch_%i' % desc['epoch']
+    np.save(out, rows)
+    print 'Wrote the ordering of epoch %i to %s' % (desc['epoch'], out)